@@ -0,0 +1,292 @@
+import os
+import sys
+import time
+import queue
+import platform
+import argparse
+import multiprocessing
+import numpy as np
+
+from image_pipeline import batched, iter_image_paths
+from ground_truth import load_captions, DEFAULT_CAPTIONS_FILE
+from host_profile import save_profile, profile_path
+
+DEFAULT_SAMPLE = 32
+# Largest drop in BLEU-4 or METEOR (absolute) accepted in exchange for throughput
+DEFAULT_QUALITY_TOLERANCE = 0.01
+# Seconds a trial may take, model load included, before it is abandoned as failed
+DEFAULT_TRIAL_TIMEOUT = 600
+START_CONFIG = {"processes": 1, "interop_threads": 1, "batch_size": 8, "workers": 2, "decode": "pil",
+                "generation": "greedy"}
+
+
+def _generations():
+    from caption_engine import GREEDY, BEAM_SEARCH
+    return {"greedy": GREEDY, "beam": BEAM_SEARCH}
+
+
+def _trial_worker(config, image_paths, model_id, barrier, results, timeout):
+    # The profile being tuned must not leak into the trial
+    os.environ["CAPTION_TUNING"] = "off"
+    os.environ["OMP_NUM_THREADS"] = str(config["threads"])
+    import torch
+    torch.set_num_threads(config["threads"])
+    torch.set_num_interop_threads(config["interop_threads"])
+    from blip_loader import get_processor, get_model
+    from caption_engine import preprocess
+    from image_pipeline import PrefetchPipeline
+
+    processor = get_processor(model_id)
+    model = get_model(model_id)
+    generate_kwargs = _generations()[config["generation"]]
+    batch_size, workers, decode = config["batch_size"], config["workers"], config["decode"]
+
+    def run(paths):
+        if workers > 0:
+            source = PrefetchPipeline(paths, processor, batch_size, workers, 2, decode)
+        else:
+            source = ((batch, preprocess(batch, processor, decode=decode)) for batch in batched(paths, batch_size))
+        captions, latencies = [], []
+        last = time.time()
+        for batch_paths, pixel_values in source:
+            with torch.no_grad():
+                out = model.generate(pixel_values=pixel_values, **generate_kwargs)
+            captions.extend(processor.batch_decode(out, skip_special_tokens=True))
+            now = time.time()
+            latencies.extend([now - last] * len(batch_paths))
+            last = now
+        return captions, latencies
+
+    run(image_paths[:batch_size])
+    # All processes start timing together, so their throughputs add up; a dead peer breaks the barrier
+    barrier.wait(timeout)
+    start = time.time()
+    captions, latencies = run(image_paths)
+    results.put((image_paths, captions, latencies, start, time.time()))
+
+
+def _collect(workers, barrier, results, timeout):
+    """One result per worker, or the reason the trial failed: a worker that exited early, or the timeout."""
+    deadline = time.time() + timeout
+    outputs = []
+    failure = None
+    while len(outputs) < len(workers):
+        try:
+            outputs.append(results.get(timeout=1))
+            continue
+        except queue.Empty:
+            pass
+        crashed = [worker.exitcode for worker in workers if worker.exitcode not in (None, 0)]
+        if crashed:
+            failure = f"worker exited with code {crashed[0]}"
+        elif time.time() > deadline:
+            failure = f"timed out after {timeout}s"
+        if failure:
+            # Wake peers still waiting to start timing, then stop whatever is left
+            barrier.abort()
+            for worker in workers:
+                worker.terminate()
+            break
+    for worker in workers:
+        worker.join()
+    return outputs, failure
+
+
+def failed_trial(config, reason):
+    return {"config": dict(config), "failed": reason, "images_per_sec": None, "latency_ms": None, "bleu4": None,
+            "meteor": None}
+
+
+def measure(config, image_paths, model_id, references, timeout=DEFAULT_TRIAL_TIMEOUT):
+    """Caption image_paths with one configuration, in fresh processes; returns throughput, latency and quality.
+
+    A configuration whose processes crash (a failed load, running out of memory) or overrun
+    timeout seconds comes back as failed_trial instead, so the search can move past it.
+    """
+    from evaluator import bleu_scores, meteor_scores
+    from blip_loader import wordnet_installed
+
+    context = multiprocessing.get_context("spawn")
+    processes = config["processes"]
+    barrier = context.Barrier(processes)
+    results = context.Queue()
+    workers = [context.Process(target=_trial_worker, args=(config, image_paths[k::processes], model_id, barrier,
+                                                           results, timeout))
+               for k in range(processes)]
+    for worker in workers:
+        worker.start()
+    outputs, failure = _collect(workers, barrier, results, timeout)
+    if failure:
+        return failed_trial(config, failure)
+
+    captions = {}
+    latencies = []
+    for paths, batch_captions, batch_latencies, _, _ in outputs:
+        captions.update(zip(paths, batch_captions))
+        latencies.extend(batch_latencies)
+    seconds = max(output[4] for output in outputs) - min(output[3] for output in outputs)
+    candidates = [captions[path].split() for path in image_paths]
+    refs = [references[path] for path in image_paths]
+    meteor = meteor_scores(refs, candidates, workers=0) if wordnet_installed() else None
+    p50, p95 = np.percentile(np.array(latencies) * 1000, [50, 95])
+    return {
+        "config": dict(config),
+        "failed": None,
+        "images_per_sec": len(image_paths) / seconds,
+        "latency_ms": {"p50": p50, "p95": p95},
+        "bleu4": float(bleu_scores(refs, candidates)[1][:, 3].mean()),
+        "meteor": float(np.mean(meteor)) if meteor is not None else None,
+    }
+
+
+def best_trial(trials, tolerance=DEFAULT_QUALITY_TOLERANCE):
+    """The fastest trial whose BLEU-4 and METEOR are within tolerance of the best seen; None if every trial failed."""
+    trials = [trial for trial in trials if not trial["failed"]]
+    if not trials:
+        return None
+    best_bleu = max(trial["bleu4"] for trial in trials)
+    meteors = [trial["meteor"] for trial in trials if trial["meteor"] is not None]
+    best_meteor = max(meteors) if meteors else None
+
+    def acceptable(trial):
+        if trial["bleu4"] < best_bleu - tolerance:
+            return False
+        return best_meteor is None or trial["meteor"] is None or trial["meteor"] >= best_meteor - tolerance
+
+    return max((trial for trial in trials if acceptable(trial)), key=lambda trial: trial["images_per_sec"])
+
+
+def parallelism_options(cpus, threads=None, processes=None):
+    """(processes, threads per process) pairs that fit on cpus cores."""
+    threads = threads or sorted({t for t in (1, 2, 4, 8, 16, 32) if t < cpus} | {cpus})
+    processes = processes or sorted({p for p in (1, 2, 4) if p <= cpus})
+    options = [(1, t) for t in threads]
+    options += [(p, max(1, cpus // p)) for p in processes if p > 1]
+    return list(dict.fromkeys(options))
+
+
+def tune(image_paths, model_id, references, parallelism, interop_threads=(1, 2), batch_sizes=(1, 4, 8, 16),
+         workers=(0, 2), decodes=("pil", "draft"), generations=("greedy", "beam"),
+         tolerance=DEFAULT_QUALITY_TOLERANCE, timeout=DEFAULT_TRIAL_TIMEOUT):
+    """Coordinate descent over the settings, one at a time, keeping the best value of each before moving on.
+
+    Every configuration runs in its own processes, since torch's thread pools cannot be resized
+    once used. Returns (best trial, all trials, best thread count for a single process); the later
+    steps keep the winning process/thread split. Failed configurations are recorded but never chosen.
+    """
+    processes, threads = parallelism[0]
+    config = dict(START_CONFIG, processes=processes, threads=threads)
+    trials = {}
+    steps = [
+        (("processes", "threads"), parallelism),
+        (("interop_threads",), [(n,) for n in interop_threads]),
+        (("batch_size",), [(n,) for n in batch_sizes]),
+        (("workers",), [(n,) for n in workers]),
+        (("decode",), [(d,) for d in decodes]),
+        (("generation",), [(g,) for g in generations]),
+    ]
+    for names, values in steps:
+        # The current value stays a candidate, so a step can never make things worse
+        values = list(dict.fromkeys([tuple(config[name] for name in names)] + list(values)))
+        step_trials = []
+        for value in values:
+            candidate = dict(config, **dict(zip(names, value)))
+            key = tuple(sorted(candidate.items()))
+            if key not in trials:
+                trials[key] = measure(candidate, image_paths, model_id, references, timeout)
+                trial = trials[key]
+                label = f"{' '.join(f'{k}={v}' for k, v in sorted(candidate.items())):<90}"
+                if trial["failed"]:
+                    print(f"{label} failed: {trial['failed']}", file=sys.stderr)
+                else:
+                    print(f"{label} {trial['images_per_sec']:6.2f} img/s  p95 {trial['latency_ms']['p95']:7.0f} ms  "
+                          f"BLEU-4 {trial['bleu4']:.4f}", file=sys.stderr)
+            step_trials.append(trials[key])
+        best = best_trial(step_trials, tolerance)
+        if best is None:
+            # Only possible in the first step; later ones always include the last winner
+            raise RuntimeError(f"every configuration failed while tuning {', '.join(names)}")
+        config = dict(best["config"])
+        if names == ("processes", "threads"):
+            # The scripts caption in one process, so they need the best single-process thread count
+            single = best_trial([trial for trial in step_trials if trial["config"]["processes"] == 1], tolerance)
+            single_threads = single["config"]["threads"] if single is not None else config["threads"]
+    trials = list(trials.values())
+    return next(trial for trial in trials if trial["config"] == config), trials, single_threads
+
+
+def build_profile(best, trials, single_threads, model_id, sample):
+    import torch
+
+    config = dict(best["config"], threads=single_threads, threads_per_process=best["config"]["threads"])
+    # Scripts keep their own decoding, so the winning generation mode is kept apart from the applied settings
+    advisory_generation = config.pop("generation")
+    return {
+        "host": platform.node(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "cpus": os.cpu_count(),
+        "torch": torch.__version__,
+        "model": model_id,
+        "sample": sample,
+        "config": config,
+        "advisory_generation": advisory_generation,
+        "metrics": {key: best[key] for key in ("images_per_sec", "latency_ms", "bleu4", "meteor")},
+        "trials": trials,
+    }
+
+
+if __name__ == "__main__":
+    from blip_loader import MODEL_ID
+
+    parser = argparse.ArgumentParser(description="Sweep threads, batch size, workers and decoding settings on a "
+                                                 "sample of the image folder and save this host's best profile")
+    parser.add_argument("--images", default="images")
+    parser.add_argument("--captions", default=DEFAULT_CAPTIONS_FILE)
+    parser.add_argument("--sample", type=int, default=DEFAULT_SAMPLE, help="images with references to caption")
+    parser.add_argument("--model", default=MODEL_ID, help="model id or local directory")
+    parser.add_argument("--threads", default=None, help="comma-separated intra-op thread counts to try")
+    parser.add_argument("--processes", default=None, help="comma-separated worker process counts to try")
+    parser.add_argument("--batch-sizes", default="1,4,8,16")
+    parser.add_argument("--workers", default="0,2", help="comma-separated prefetch worker counts to try")
+    parser.add_argument("--decodes", default="pil,draft")
+    parser.add_argument("--generations", default="greedy,beam",
+                        help="decoding modes to compare; reported, but never applied to the scripts")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_QUALITY_TOLERANCE,
+                        help="largest BLEU-4/METEOR drop accepted for more throughput")
+    parser.add_argument("--trial-timeout", type=float, default=DEFAULT_TRIAL_TIMEOUT,
+                        help="seconds before a configuration is abandoned as failed")
+    parser.add_argument("--output", default=None, help=f"profile path (default: {profile_path()})")
+    args = parser.parse_args()
+
+    def ints(text):
+        return [int(n) for n in text.split(",")] if text else None
+
+    ground_truth = load_captions(args.captions)
+    image_paths = [path for path in iter_image_paths(args.images) if os.path.basename(path) in ground_truth]
+    image_paths = image_paths[:args.sample]
+    references = {path: [caption.split() for caption in ground_truth.captions(os.path.basename(path))]
+                  for path in image_paths}
+
+    parallelism = parallelism_options(os.cpu_count() or 1, ints(args.threads), ints(args.processes))
+    best, trials, single_threads = tune(image_paths, args.model, references, parallelism, batch_sizes=ints(args.batch_sizes),
+                        workers=ints(args.workers), decodes=args.decodes.split(","),
+                        generations=args.generations.split(","), tolerance=args.tolerance,
+                        timeout=args.trial_timeout)
+
+    print(f"\n{'processes':>9} {'threads':>7} {'interop':>7} {'batch':>5} {'workers':>7} {'decode':>6} "
+          f"{'generation':>10} {'img/s':>7} {'p95 ms':>7} {'BLEU-4':>7} {'METEOR':>7}")
+    for trial in sorted(trials, key=lambda trial: (bool(trial["failed"]), -(trial["images_per_sec"] or 0))):
+        c = trial["config"]
+        row = (f"{c['processes']:>9} {c['threads']:>7} {c['interop_threads']:>7} {c['batch_size']:>5} "
+               f"{c['workers']:>7} {c['decode']:>6} {c['generation']:>10}")
+        if trial["failed"]:
+            print(f"{row} failed: {trial['failed']}")
+            continue
+        meteor = f"{trial['meteor']:.4f}" if trial["meteor"] is not None else "-"
+        marker = " *" if trial is best else ""
+        print(f"{row} {trial['images_per_sec']:>7.2f} {trial['latency_ms']['p95']:>7.0f} {trial['bleu4']:>7.4f} "
+              f"{meteor:>7}{marker}")
+    path = save_profile(build_profile(best, trials, single_threads, args.model, len(image_paths)), args.output)
+    print(f"\nSaved the starred configuration to {path}; scripts on this host pick up its thread, batch, worker "
+          f"and decode settings automatically. The generation column is advice only: scripts keep their own "
+          f"decoding, since it changes the scores they report.")
@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+import warnings
+import torch
+
+BACKENDS = ("eager", "compile", "trace")
+DEFAULT_CACHE_DIR = os.path.join(".cache", "backends")
+
+
+class TracedVisionModel(torch.nn.Module):
+    """Stands in for model.vision_model, running a TorchScript trace of it at the processor's fixed resolution."""
+
+    def __init__(self, traced, image_size):
+        super().__init__()
+        self.traced = traced
+        self.image_size = image_size
+
+    def forward(self, pixel_values=None, interpolate_pos_encoding=False, **kwargs):
+        if interpolate_pos_encoding or tuple(pixel_values.shape[-2:]) != (self.image_size, self.image_size):
+            raise ValueError(f"the traced vision encoder only accepts {self.image_size}x{self.image_size} images")
+        # Same layout as the eager model with return_dict=False; callers only read [0]
+        return (self.traced(pixel_values),)
+
+
+class _VisionEncoder(torch.nn.Module):
+    # Tensor-in, tensor-out wrapper so torch.jit.trace sees a plain function of pixel_values
+    def __init__(self, vision_model):
+        super().__init__()
+        self.vision_model = vision_model
+
+    def forward(self, pixel_values):
+        return self.vision_model(pixel_values=pixel_values, return_dict=False)[0]
+
+
+def _trace_vision(model, model_id, cache_dir):
+    from precision import artifact_path
+
+    image_size = model.config.vision_config.image_size
+    path = None
+    if model_id is not None and cache_dir is not None:
+        variant = f"{getattr(model, 'precision_mode', 'fp32')}-trace{image_size}"
+        path = artifact_path(model_id, variant, cache_dir) + ".pt"
+    if path is not None and os.path.exists(path):
+        traced = torch.jit.load(path)
+    else:
+        example = torch.zeros(1, 3, image_size, image_size)
+        with torch.no_grad(), warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            traced = torch.jit.trace(_VisionEncoder(model.vision_model).eval(), (example,))
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            torch.jit.save(traced, tmp_path)
+            os.replace(tmp_path, path)
+    model.vision_model = TracedVisionModel(traced.eval(), image_size)
+
+
+def _compile_decoder(model, cache_dir):
+    import torch._dynamo
+    from torch._inductor.runtime.cache_dir_utils import default_cache_dir
+
+    # Inductor keeps compiled kernels here, so later processes reuse them instead of compiling again.
+    # Importing transformers already fills in torch's default, so only a user's own choice is kept.
+    if cache_dir is not None and os.environ.get("TORCHINDUCTOR_CACHE_DIR", default_cache_dir()) == default_cache_dir():
+        os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(os.path.join(cache_dir, "inductor"))
+    # A graph that fails to compile later (a new shape, say) runs eagerly instead of raising
+    torch._dynamo.config.suppress_errors = True
+    decoder = model.text_decoder
+    eager_forward = decoder.forward
+    # generate() calls the module, which dispatches to forward; wrapping the module would be bypassed
+    decoder.forward = torch.compile(eager_forward, dynamic=True)
+    try:
+        # Compilation is lazy, so run a short generate now to fail (and pay the cost) at load time
+        image_size = model.config.vision_config.image_size
+        with torch.no_grad():
+            model.generate(pixel_values=torch.zeros(1, 3, image_size, image_size), max_new_tokens=2)
+    except Exception:
+        decoder.forward = eager_forward
+        raise
+
+
+def apply_backend(model, backend, model_id=None, cache_dir=DEFAULT_CACHE_DIR):
+    """Run model with an execution backend, falling back to eager if it cannot be built.
+
+    "compile" wraps the text decoder's forward in torch.compile, cutting the per-step dispatch
+    overhead of generate; "trace" swaps the vision encoder for a TorchScript trace at the fixed
+    processor resolution, saved under cache_dir when model_id is given. model.backend records the
+    backend actually in use and model.backend_seconds what building it cost.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown backend {backend!r}; use one of {', '.join(BACKENDS)}")
+    start = time.perf_counter()
+    try:
+        if backend == "trace":
+            _trace_vision(model, model_id, cache_dir)
+        elif backend == "compile":
+            _compile_decoder(model, cache_dir)
+    except Exception as e:
+        print(f"Backend {backend!r} failed ({type(e).__name__}: {e}); using eager.", file=sys.stderr)
+        backend = "eager"
+    model.backend = backend
+    model.backend_seconds = time.perf_counter() - start
+    return model
@@ -0,0 +1,225 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import platform
+import resource
+import tempfile
+import multiprocessing
+import numpy as np
+
+from image_pipeline import batched, iter_image_paths
+from ground_truth import load_captions, DEFAULT_CAPTIONS_FILE
+
+# A BLIP with the base model's image size and patching but tiny transformer stacks, so a run
+# measures the real preprocessing and decoding loop without downloading any weights
+TINY_CONFIG = {
+    "vision_config": {"hidden_size": 64, "intermediate_size": 128, "num_hidden_layers": 2,
+                      "num_attention_heads": 2, "image_size": 384, "patch_size": 16},
+    "text_config": {"hidden_size": 64, "intermediate_size": 128, "num_hidden_layers": 2,
+                    "num_attention_heads": 2, "max_position_embeddings": 64},
+}
+SPECIAL_TOKENS = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "[DEC]"]
+DEFAULT_BATCH_SIZES = (1, 4, 8)
+DEFAULT_OUTPUT = "benchmark.json"
+# Relative slowdown / growth that counts as a regression against a baseline run
+DEFAULT_TOLERANCE = 0.10
+
+
+def build_tiny_blip(captions_file=DEFAULT_CAPTIONS_FILE, seed=0):
+    """A randomly initialised BlipForConditionalGeneration and a matching processor, built offline.
+
+    The tokenizer vocabulary is every lowercased word in captions_file. With small random weights
+    the end-of-sentence token is never favoured, so every caption runs to the full generation
+    length and each run does the same amount of work.
+    """
+    import torch
+    from transformers import (BlipConfig, BlipForConditionalGeneration, BlipProcessor, BlipImageProcessor,
+                              BertTokenizerFast)
+
+    words = sorted({token.lower() for token in load_captions(captions_file).vocab} - set(SPECIAL_TOKENS))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        vocab_file = os.path.join(tmp_dir, "vocab.txt")
+        with open(vocab_file, "w", encoding="utf-8") as f:
+            f.write("\n".join(SPECIAL_TOKENS + words))
+        tokenizer = BertTokenizerFast(vocab_file, bos_token="[DEC]")
+    processor = BlipProcessor(BlipImageProcessor(), tokenizer)
+
+    text_config = dict(TINY_CONFIG["text_config"], vocab_size=len(tokenizer),
+                       bos_token_id=tokenizer.bos_token_id, sep_token_id=tokenizer.sep_token_id,
+                       eos_token_id=tokenizer.sep_token_id, pad_token_id=tokenizer.pad_token_id)
+    torch.manual_seed(seed)
+    model = BlipForConditionalGeneration(BlipConfig(vision_config=TINY_CONFIG["vision_config"],
+                                                    text_config=text_config))
+    model.decoder_input_ids = tokenizer.bos_token_id
+    return processor, model.eval()
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 ** 2 if sys.platform == "darwin" else 1024)
+
+
+def run_config(mode, batch_size, image_paths, captions_file=DEFAULT_CAPTIONS_FILE, seed=0, backend="eager"):
+    """Caption and score image_paths with one decoding mode, batch size and backend; meant for a fresh process."""
+    # Runs must stay comparable with the baseline whatever this host's tuning profile says
+    os.environ["CAPTION_TUNING"] = "off"
+    from caption_engine import generate_captions, GREEDY, BEAM_SEARCH
+    from evaluator import bleu_scores, meteor_scores
+    from blip_loader import wordnet_installed
+    from backends import apply_backend, DEFAULT_CACHE_DIR
+
+    generate_kwargs = {"greedy": GREEDY, "beam": BEAM_SEARCH}[mode]
+    processor, model = build_tiny_blip(captions_file, seed)
+    # Warm-up covers building the backend and the first batch, where lazy compilation finishes;
+    # the tiny model has no stable id, so traces are not reused but compiled kernels are
+    start = time.perf_counter()
+    apply_backend(model, backend, cache_dir=DEFAULT_CACHE_DIR)
+    generate_captions(image_paths[:batch_size], processor, model, batch_size=batch_size, workers=0,
+                      **generate_kwargs)
+    warmup_seconds = time.perf_counter() - start
+
+    # Same caption path as the scripts, minus the embedding cache and result store so every image is computed
+    latencies, captions = [], []
+    start = time.perf_counter()
+    for batch_paths in batched(image_paths, batch_size):
+        batch_start = time.perf_counter()
+        captions.extend(generate_captions(batch_paths, processor, model, batch_size=batch_size, workers=0,
+                                          **generate_kwargs))
+        latencies.extend([time.perf_counter() - batch_start] * len(batch_paths))
+    caption_seconds = time.perf_counter() - start
+
+    ground_truth = load_captions(captions_file)
+    names = [os.path.basename(path) for path in image_paths]
+    scored = [i for i, name in enumerate(names) if name in ground_truth]
+    references = [[caption.split() for caption in ground_truth.captions(names[i])] for i in scored]
+    candidates = [captions[i].split() for i in scored]
+    start = time.perf_counter()
+    corpus_bleu, sentence_bleu = bleu_scores(references, candidates) if scored else (np.zeros(4), np.zeros((0, 4)))
+    meteor = meteor_scores(references, candidates, workers=0) if scored and wordnet_installed() else None
+    score_seconds = time.perf_counter() - start
+
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+    return {
+        "mode": mode,
+        "batch_size": batch_size,
+        "backend": model.backend,
+        "requested_backend": backend,
+        "images": len(image_paths),
+        "images_per_sec": len(image_paths) / caption_seconds,
+        "latency_ms": {"p50": p50, "p95": p95, "p99": p99},
+        "warmup_seconds": warmup_seconds,
+        "caption_seconds": caption_seconds,
+        "score_seconds": score_seconds,
+        "peak_rss_mb": _peak_rss_mb(),
+        "mean_bleu4": float(sentence_bleu[:, 3].mean()) if scored else None,
+        "mean_meteor": float(np.mean(meteor)) if meteor else None,
+        # Changes whenever the generated text does, even if the timings do not
+        "captions_sha256": hashlib.sha256("\n".join(captions).encode()).hexdigest(),
+    }
+
+
+def run_suite(image_paths, batch_sizes=DEFAULT_BATCH_SIZES, modes=("greedy", "beam"),
+              captions_file=DEFAULT_CAPTIONS_FILE, seed=0, backends=("eager",)):
+    """Run every (backend, mode, batch size) in its own process so peak RSS and warm-up are measured per configuration."""
+    import torch
+    import transformers
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for backend in backends:
+        for mode in modes:
+            for batch_size in batch_sizes:
+                with context.Pool(1) as pool:
+                    row = pool.apply(run_config, (mode, batch_size, image_paths, captions_file, seed, backend))
+                print(f"{backend:<7} {mode:<6} batch {batch_size:>3}: {row['images_per_sec']:.2f} img/s, "
+                      f"p95 {row['latency_ms']['p95']:.0f} ms, warm-up {row['warmup_seconds']:.1f} s, "
+                      f"peak RSS {row['peak_rss_mb']:.0f} MiB")
+                results.append(row)
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "model": TINY_CONFIG,
+        "seed": seed,
+        "results": results,
+    }
+
+
+def find_regressions(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Human-readable regressions of report against a baseline report from the same suite."""
+    # Reports from before backends were benchmarked only ran eager
+    def key(row):
+        return row.get("requested_backend", "eager"), row["mode"], row["batch_size"]
+
+    previous = {key(row): row for row in baseline["results"]}
+    regressions = []
+    for row in report["results"]:
+        old = previous.get(key(row))
+        if old is None:
+            continue
+        label = f"{key(row)[0]} {row['mode']} batch {row['batch_size']}"
+        if row["backend"] != old.get("backend", "eager"):
+            regressions.append(f"{label}: backend fell back from {old.get('backend', 'eager')} to {row['backend']}")
+        if row["images_per_sec"] < old["images_per_sec"] * (1 - tolerance):
+            regressions.append(f"{label}: throughput {old['images_per_sec']:.2f} -> {row['images_per_sec']:.2f} img/s")
+        if row["latency_ms"]["p95"] > old["latency_ms"]["p95"] * (1 + tolerance):
+            regressions.append(f"{label}: p95 latency {old['latency_ms']['p95']:.0f} -> "
+                               f"{row['latency_ms']['p95']:.0f} ms")
+        if row["peak_rss_mb"] > old["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{label}: peak RSS {old['peak_rss_mb']:.0f} -> {row['peak_rss_mb']:.0f} MiB")
+        if row["captions_sha256"] != old["captions_sha256"] and report["seed"] == baseline["seed"]:
+            regressions.append(f"{label}: generated captions changed")
+    return regressions
+
+
+def print_report(report):
+    print(f"\n{'backend':<8} {'mode':<6} {'batch':>5} {'warm-up s':>9} {'img/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'RSS MiB':>8} {'BLEU-4':>7}")
+    for row in report["results"]:
+        latency = row["latency_ms"]
+        bleu = f"{row['mean_bleu4']:.4f}" if row["mean_bleu4"] is not None else "-"
+        # A backend that fell back to eager is shown as e.g. "compile>eager"
+        backend = row["backend"] if row["backend"] == row["requested_backend"] else \
+            f"{row['requested_backend']}>{row['backend']}"
+        print(f"{backend:<8} {row['mode']:<6} {row['batch_size']:>5} {row['warmup_seconds']:>9.2f} "
+              f"{row['images_per_sec']:>8.2f} {latency['p50']:>8.1f} {latency['p95']:>8.1f} {latency['p99']:>8.1f} "
+              f"{row['peak_rss_mb']:>8.0f} {bleu:>7}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline throughput/latency/memory benchmark on a tiny random BLIP")
+    parser.add_argument("--images", default="images")
+    parser.add_argument("--captions", default=DEFAULT_CAPTIONS_FILE)
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--batch-sizes", default=",".join(map(str, DEFAULT_BATCH_SIZES)))
+    parser.add_argument("--modes", default="greedy,beam")
+    parser.add_argument("--backends", default="eager", help="comma-separated: eager, compile, trace")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    parser.add_argument("--baseline", default=None, help="earlier JSON report to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    image_paths = list(iter_image_paths(args.images, args.limit))
+    report = run_suite(image_paths, [int(b) for b in args.batch_sizes.split(",")], args.modes.split(","),
+                       args.captions, backends=args.backends.split(","))
+    print_report(report)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nWrote {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
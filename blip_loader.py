@@ -0,0 +1,161 @@
+import os
+import sys
+import time
+
+MODEL_ID = "Salesforce/blip-image-captioning-base"
+
+# Seconds spent in each cold-start phase, filled in as the phases run
+startup_times = {}
+
+# One processor per model id, one model per (model id, precision, backend)
+_processors = {}
+_models = {}
+
+
+def _timed(phase, fn):
+    start = time.perf_counter()
+    result = fn()
+    startup_times[phase] = startup_times.get(phase, 0.0) + time.perf_counter() - start
+    return result
+
+
+def _import_torch():
+    def do_import():
+        import torch
+        return torch
+    return _timed("imports", do_import)
+
+
+def _import_transformers():
+    def do_import():
+        import transformers
+        return transformers
+    return _timed("imports", do_import)
+
+
+# The scripts import this module before caption_engine and image_dataset, which import torch at
+# module level; importing it here first puts its cost in the "imports" phase rather than before it
+_import_torch()
+
+
+def wordnet_installed():
+    """Whether the WordNet corpus METEOR needs is already on disk; never touches the network."""
+    import nltk
+    for resource in ("corpora/wordnet", "corpora/wordnet.zip"):
+        try:
+            nltk.data.find(resource)
+            return True
+        except LookupError:
+            pass
+    return False
+
+
+def ensure_wordnet():
+    """Make sure the WordNet corpus METEOR needs is available, downloading only if it is missing."""
+    import nltk
+    if wordnet_installed():
+        return True
+    if not nltk.download("wordnet", quiet=True):
+        print("WordNet is not installed and could not be downloaded; METEOR scores will fail.", file=sys.stderr)
+        return False
+    return True
+
+
+def _from_pretrained(cls, model_id, **kwargs):
+    # Prefer the local Hugging Face cache so a warm start never touches the network
+    try:
+        return cls.from_pretrained(model_id, local_files_only=True, **kwargs)
+    except OSError:
+        return cls.from_pretrained(model_id, **kwargs)
+
+
+def get_processor(model_id=MODEL_ID):
+    """The process-wide BlipProcessor for model_id, loaded on first use."""
+    if model_id not in _processors:
+        transformers = _import_transformers()
+        _processors[model_id] = _timed("processor", lambda: _from_pretrained(transformers.BlipProcessor, model_id))
+    return _processors[model_id]
+
+
+def get_model(model_id=MODEL_ID, precision=None, backend=None):
+    """The process-wide BlipForConditionalGeneration in eval mode, loaded on first use.
+
+    Weights come from the safetensors checkpoint, which from_pretrained memory-maps rather than
+    reading into a separate buffer. precision is "fp32", "int8" (dynamically quantized Linear
+    layers) or "bf16", defaulting to $CAPTION_PRECISION or fp32; converted models are cached on disk.
+    backend is "eager", "compile" or "trace" (see backends.apply_backend), defaulting to
+    $CAPTION_BACKEND or eager. Thread counts from this host's tuning profile are applied first.
+    """
+    precision = precision or os.environ.get("CAPTION_PRECISION", "fp32")
+    backend = backend or os.environ.get("CAPTION_BACKEND", "eager")
+    key = (model_id, precision, backend)
+    if key not in _models:
+        from host_profile import apply_threads
+        apply_threads()
+        transformers = _import_transformers()
+
+        def load_fp32():
+            return _from_pretrained(transformers.BlipForConditionalGeneration, model_id)
+
+        if precision == "fp32":
+            model = _timed("weights", load_fp32)
+        else:
+            from precision import load_model
+            model = _timed("weights", lambda: load_model(model_id, precision, load_fp32))
+        model.eval()
+        if backend != "eager":
+            from backends import apply_backend
+            model = _timed("backend", lambda: apply_backend(model, backend, model_id))
+        _models[key] = model
+    return _models[key]
+
+
+def model_fingerprint_for(model_id=MODEL_ID, precision=None):
+    """embedding_cache.model_fingerprint of get_model(model_id, precision), read from the config alone.
+
+    Lets a caller look up stored results before deciding whether the weights need loading at all.
+    """
+    import torch
+    from embedding_cache import fingerprint
+
+    precision = precision or os.environ.get("CAPTION_PRECISION", "fp32")
+    config = _from_pretrained(_import_transformers().BlipConfig, model_id)
+    if precision == "bf16":
+        dtype = torch.bfloat16
+    else:
+        # from_pretrained keeps the checkpoint's dtype
+        dtype = config.dtype if isinstance(getattr(config, "dtype", None), torch.dtype) else torch.float32
+    return fingerprint(model_id, getattr(config, "_commit_hash", None), dtype, precision)
+
+
+def measure_first_token(image_path, processor=None, model=None):
+    """Time from a loaded model to the first generated token for one image."""
+    import torch
+    from PIL import Image
+
+    processor = processor or get_processor()
+    model = model or get_model()
+    start = time.perf_counter()
+    inputs = processor(Image.open(image_path).convert("RGB"), return_tensors="pt")
+    with torch.no_grad():
+        model.generate(**inputs, max_new_tokens=1)
+    startup_times["first_token"] = time.perf_counter() - start
+    return startup_times["first_token"]
+
+
+def print_startup_report():
+    print("\nStartup Time:")
+    for phase in ("imports", "processor", "weights", "backend", "first_token"):
+        if phase in startup_times:
+            print(f"{phase}: {startup_times[phase]:.2f}s")
+    print(f"total: {sum(startup_times.values()):.2f}s")
+
+
+if __name__ == "__main__":
+    image_folder = sys.argv[1] if len(sys.argv) > 1 else "images"
+    first_image = sorted(f for f in os.listdir(image_folder) if f.lower().endswith(".jpg"))[0]
+    ensure_wordnet()
+    get_processor()
+    get_model()
+    measure_first_token(os.path.join(image_folder, first_image))
+    print_startup_report()
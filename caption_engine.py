@@ -0,0 +1,241 @@
+import os
+import time
+import argparse
+import numpy as np
+import torch
+
+from image_pipeline import PrefetchPipeline, batched, load_image, iter_image_paths
+from embedding_cache import model_fingerprint
+from fast_decode import fast_preprocessor, decode_mode
+from host_profile import tuned
+
+# Decoding settings used by the scripts
+GREEDY = {}
+BEAM_SEARCH = {"num_beams": 5, "early_stopping": True}
+
+DEFAULT_BATCH_SIZE = 8
+# Decode/preprocess threads working ahead of the model, and how many batches they may hold
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_DEPTH = 2
+
+
+def encode_images(model, pixel_values):
+    """Run only the BLIP vision encoder; returns the image embeddings the text decoder attends to."""
+    with torch.no_grad():
+        return model.vision_model(pixel_values=pixel_values)[0]
+
+
+def generate_from_embeds(model, image_embeds, **generate_kwargs):
+    """The text-decoder half of BlipForConditionalGeneration.generate, for precomputed image embeddings."""
+    text_config = model.config.text_config
+    input_ids = torch.full((image_embeds.shape[0], 1), text_config.bos_token_id, dtype=torch.long)
+    image_attention_mask = torch.ones(image_embeds.shape[:-1], dtype=torch.long)
+    with torch.no_grad():
+        return model.text_decoder.generate(
+            input_ids=input_ids,
+            eos_token_id=text_config.sep_token_id,
+            pad_token_id=text_config.pad_token_id,
+            encoder_hidden_states=image_embeds,
+            encoder_attention_mask=image_attention_mask,
+            **generate_kwargs,
+        )
+
+
+def preprocess(image_paths, processor, dataset=None, decode="pil"):
+    """pixel_values for a batch of image files, read from an ImageDataset instead of the JPEGs when given."""
+    if dataset is not None:
+        return dataset.pixel_values(image_paths, processor)
+    if decode == "draft":
+        return fast_preprocessor(processor)(image_paths)
+    return processor([load_image(path) for path in image_paths], return_tensors="pt")["pixel_values"]
+
+
+def encode_with_cache(image_paths, processor, model, cache, dataset=None, decode="pil"):
+    """Image embeddings for a batch, encoding only the images the cache has not seen."""
+    source = "dataset" if dataset is not None else decode
+    keys = [cache.key(path, model, source) for path in image_paths]
+    embeds = [cache.get(key) for key in keys]
+    missing = [i for i, e in enumerate(embeds) if e is None]
+    if missing:
+        pixel_values = preprocess([image_paths[i] for i in missing], processor, dataset, decode)
+        for i, image_embeds in zip(missing, encode_images(model, pixel_values)):
+            embeds[i] = image_embeds.float().numpy()
+            cache.put(keys[i], embeds[i])
+    dtype = next(model.text_decoder.parameters()).dtype
+    return torch.from_numpy(np.stack(embeds)).to(dtype)
+
+
+def caption_batch(images, processor, model, **generate_kwargs):
+    """Caption a list of PIL images with a single generate call."""
+    inputs = processor(images, return_tensors="pt")
+    with torch.no_grad():
+        out = model.generate(**inputs, **generate_kwargs)
+    return processor.batch_decode(out, skip_special_tokens=True)
+
+
+def generate_captions(image_paths, processor, model, batch_size=None, workers=None, queue_depth=DEFAULT_QUEUE_DEPTH,
+                      cache=None, store=None, instrumentation=None, dataset=None, decode=None, **generate_kwargs):
+    """Caption every image in image_paths, returning captions in input order.
+
+    With workers > 0 the next batches are decoded and preprocessed in the background while the
+    model runs on the current one. With an EmbeddingCache, images it already holds skip decoding
+    and the vision encoder entirely; only the text decoder runs. With a ResultStore, images already
+    captioned by this model with these settings are not run at all, and new captions are recorded.
+    With enabled Instrumentation, images run serially through the uncached path, one timed stage at a
+    time. With an ImageDataset, pixels come from its memory-mapped array rather than the JPEGs and
+    the prefetch workers are not needed. decode="draft" (default $CAPTION_DECODE, else the profile's) decodes
+    JPEGs at reduced scale straight into a batch buffer; see fast_decode.py. batch_size and workers
+    default to this host's tuning profile (autotune.py), else DEFAULT_BATCH_SIZE and DEFAULT_WORKERS.
+    """
+    batch_size = batch_size or tuned("batch_size", DEFAULT_BATCH_SIZE)
+    workers = tuned("workers", DEFAULT_WORKERS) if workers is None else workers
+    decode = decode_mode(decode)
+    if store is not None:
+        return _generate_with_store(image_paths, processor, model, store, batch_size, workers, queue_depth, cache,
+                                    instrumentation, dataset, decode, **generate_kwargs)
+
+    if instrumentation is not None and instrumentation.enabled:
+        return _generate_instrumented(image_paths, processor, model, batch_size, instrumentation, dataset, decode,
+                                      **generate_kwargs)
+
+    captions = []
+    if cache is not None:
+        for batch_paths in batched(image_paths, batch_size):
+            image_embeds = encode_with_cache(batch_paths, processor, model, cache, dataset, decode)
+            out = generate_from_embeds(model, image_embeds, **generate_kwargs)
+            captions.extend(processor.batch_decode(out, skip_special_tokens=True))
+        return captions
+
+    if dataset is not None or (workers <= 0 and decode != "pil"):
+        for batch_paths in batched(image_paths, batch_size):
+            pixel_values = preprocess(batch_paths, processor, dataset, decode)
+            with torch.no_grad():
+                out = model.generate(pixel_values=pixel_values, **generate_kwargs)
+            captions.extend(processor.batch_decode(out, skip_special_tokens=True))
+        return captions
+
+    if workers <= 0:
+        for batch_paths in batched(image_paths, batch_size):
+            images = [load_image(path) for path in batch_paths]
+            captions.extend(caption_batch(images, processor, model, **generate_kwargs))
+        return captions
+
+    pipeline = PrefetchPipeline(image_paths, processor, batch_size, workers, queue_depth, decode)
+    return caption_pipeline(pipeline, processor, model, **generate_kwargs)
+
+
+def _generate_with_store(image_paths, processor, model, store, batch_size, workers, queue_depth, cache,
+                         instrumentation, dataset, decode, **generate_kwargs):
+    image_paths = list(image_paths)
+    model_id = model_fingerprint(model)
+    records = [store.get(path, model_id, generate_kwargs) for path in image_paths]
+    missing = [path for path, record in zip(image_paths, records) if record is None]
+
+    start = time.perf_counter()
+    new_captions = iter(generate_captions(missing, processor, model, batch_size, workers, queue_depth, cache,
+                                          instrumentation=instrumentation, dataset=dataset, decode=decode,
+                                          **generate_kwargs)
+                        if missing else [])
+    # Amortised per-image wall time of this run
+    seconds = (time.perf_counter() - start) / max(len(missing), 1)
+
+    captions = []
+    for path, record in zip(image_paths, records):
+        if record is None:
+            record = store.put(path, model_id, generate_kwargs, next(new_captions), seconds=seconds)
+        captions.append(record["caption"])
+    return captions
+
+
+def _generate_instrumented(image_paths, processor, model, batch_size, instrumentation, dataset, decode,
+                           **generate_kwargs):
+    fast = fast_preprocessor(processor) if decode == "draft" else None
+    captions = []
+    for batch_paths in batched(image_paths, batch_size):
+        instrumentation.begin_batch([os.path.basename(path) for path in batch_paths])
+        if dataset is not None:
+            # Decoding and resizing happened at conversion time; only the normalisation is left
+            with instrumentation.stage("processor"):
+                pixel_values = dataset.pixel_values(batch_paths, processor)
+        elif fast is not None:
+            with instrumentation.stage("pil_decode"):
+                pixels = fast.decode(batch_paths)
+            with instrumentation.stage("processor"):
+                pixel_values = fast.normalize(pixels)
+        else:
+            with instrumentation.stage("pil_decode"):
+                images = [load_image(path) for path in batch_paths]
+            with instrumentation.stage("processor"):
+                pixel_values = processor(images, return_tensors="pt")["pixel_values"]
+        with instrumentation.stage("vision_encoder"):
+            image_embeds = encode_images(model, pixel_values)
+        with instrumentation.stage("generate"):
+            out = generate_from_embeds(model, image_embeds, **generate_kwargs)
+        with instrumentation.stage("text_decode"):
+            captions.extend(processor.batch_decode(out, skip_special_tokens=True))
+    return captions
+
+
+def caption_pipeline(pipeline, processor, model, **generate_kwargs):
+    """Run the model over batches a PrefetchPipeline has already preprocessed."""
+    captions = []
+    for _, pixel_values in pipeline:
+        with torch.no_grad():
+            out = model.generate(pixel_values=pixel_values, **generate_kwargs)
+        captions.extend(processor.batch_decode(out, skip_special_tokens=True))
+    return captions
+
+
+def generate_caption(image_path, processor, model, **generate_kwargs):
+    # The original one-image-at-a-time path, kept for comparison
+    return caption_batch([load_image(image_path)], processor, model, **generate_kwargs)[0]
+
+
+def compare_throughput(image_paths, processor, model, batch_sizes=(1, 4, 8, 16), **generate_kwargs):
+    """Time the per-image loop against batched generation on the same images."""
+    image_paths = list(image_paths)
+    results = []
+
+    start = time.perf_counter()
+    baseline = [generate_caption(path, processor, model, **generate_kwargs) for path in image_paths]
+    elapsed = time.perf_counter() - start
+    results.append({"mode": "per-image", "batch_size": 1, "seconds": elapsed,
+                    "images_per_sec": len(image_paths) / elapsed, "matches_baseline": len(image_paths)})
+
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        captions = generate_captions(image_paths, processor, model, batch_size=batch_size, **generate_kwargs)
+        elapsed = time.perf_counter() - start
+        matches = sum(a == b for a, b in zip(captions, baseline))
+        results.append({"mode": "batched", "batch_size": batch_size, "seconds": elapsed,
+                        "images_per_sec": len(image_paths) / elapsed, "matches_baseline": matches})
+    return results
+
+
+def print_comparison(results, num_images):
+    print(f"{'mode':<10} {'batch':>5} {'seconds':>9} {'img/s':>8} {'speedup':>8} {'same':>6}")
+    base = results[0]["images_per_sec"]
+    for row in results:
+        print(f"{row['mode']:<10} {row['batch_size']:>5} {row['seconds']:>9.2f} {row['images_per_sec']:>8.2f} "
+              f"{row['images_per_sec'] / base:>7.2f}x {row['matches_baseline']:>3}/{num_images}")
+
+
+if __name__ == "__main__":
+    from blip_loader import get_processor, get_model
+
+    parser = argparse.ArgumentParser(description="Compare per-image and batched BLIP captioning throughput")
+    parser.add_argument("--images", default="images")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--batch-sizes", default="1,4,8,16")
+    parser.add_argument("--beam", action="store_true", help="use num_beams=5 instead of greedy decoding")
+    args = parser.parse_args()
+
+    processor = get_processor()
+    model = get_model()
+
+    image_paths = list(iter_image_paths(args.images, args.limit))
+    batch_sizes = [int(b) for b in args.batch_sizes.split(",")]
+    generate_kwargs = BEAM_SEARCH if args.beam else GREEDY
+
+    results = compare_throughput(image_paths, processor, model, batch_sizes, **generate_kwargs)
+    print_comparison(results, len(image_paths))
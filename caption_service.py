@@ -0,0 +1,335 @@
+import io
+import json
+import time
+import asyncio
+import argparse
+import itertools
+import functools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+from caption_engine import caption_batch, GREEDY, BEAM_SEARCH
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+DEFAULT_MAX_BATCH = 8
+DEFAULT_MAX_WAIT_MS = 10
+# Latencies kept for the percentiles in /metrics
+LATENCY_WINDOW = 10000
+MAX_BODY_BYTES = 32 * 1024 ** 2
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class MicroBatcher:
+    """Collect concurrent caption requests into batches for a single model thread.
+
+    A batch is dispatched once it holds max_batch images or max_wait seconds after its first
+    request arrived, whichever comes first. One batch runs at a time; requests arriving meanwhile
+    wait in the queue and form the next batch.
+    """
+
+    def __init__(self, processor, model, max_batch=DEFAULT_MAX_BATCH, max_wait=DEFAULT_MAX_WAIT_MS / 1000,
+                 **generate_kwargs):
+        self.processor = processor
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.generate_kwargs = generate_kwargs
+        self.requests = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.batch_sizes = collections.Counter()
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self._pending = collections.deque()
+        self._arrival = None
+        self._task = None
+        self._started = time.perf_counter()
+        # torch releases the GIL, so the event loop keeps serving while a batch runs here
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="caption-model")
+
+    def start(self):
+        self._arrival = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._executor.shutdown()
+
+    async def caption(self, image):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((image, future, time.perf_counter()))
+        self._arrival.set()
+        return await future
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        while not self._pending:
+            self._arrival.clear()
+            await self._arrival.wait()
+        batch = [self._pending.popleft()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            if self._pending:
+                batch.append(self._pending.popleft())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            self._arrival.clear()
+            try:
+                await asyncio.wait_for(self._arrival.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            images = [image for image, _, _ in batch]
+            start = time.perf_counter()
+            try:
+                captions = await loop.run_in_executor(self._executor, functools.partial(
+                    caption_batch, images, self.processor, self.model, **self.generate_kwargs))
+            except Exception as e:
+                self.errors += len(batch)
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                self.busy_seconds += time.perf_counter() - start
+
+            done = time.perf_counter()
+            self.requests += len(batch)
+            self.batch_sizes[len(batch)] += 1
+            for (_, future, enqueued), caption in zip(batch, captions):
+                self.latencies.append(done - enqueued)
+                # The client may have gone away while the batch ran
+                if not future.done():
+                    future.set_result(caption)
+
+    def metrics(self):
+        latencies = np.array(self.latencies) * 1000
+        percentiles = np.percentile(latencies, [50, 95, 99]) if len(latencies) else [None] * 3
+        uptime = time.perf_counter() - self._started
+        return {
+            "status": "ok",
+            "queue_depth": len(self._pending),
+            "requests": self.requests,
+            "errors": self.errors,
+            "batches": sum(self.batch_sizes.values()),
+            "batch_size_histogram": {str(size): count for size, count in sorted(self.batch_sizes.items())},
+            "latency_ms": {name: None if value is None else round(float(value), 2)
+                           for name, value in zip(("p50", "p95", "p99"), percentiles)},
+            "model_busy": round(self.busy_seconds / uptime, 4) if uptime else 0.0,
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000,
+            "uptime_seconds": round(uptime, 1),
+        }
+
+
+class _HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+async def _read_message(reader):
+    """(start line, headers, body) of one HTTP/1.1 message, or None when the peer closed the connection."""
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError:
+        return None
+    lines = head.decode("latin-1").split("\r\n")
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length > MAX_BODY_BYTES:
+        raise _HttpError(413, f"body larger than {MAX_BODY_BYTES} bytes")
+    body = await reader.readexactly(length) if length else b""
+    return lines[0], headers, body
+
+
+def _response(status, payload, keep_alive=True):
+    body = json.dumps(payload).encode()
+    head = (f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    return head.encode() + body
+
+
+def _decode_image(data):
+    return Image.open(io.BytesIO(data)).convert("RGB")
+
+
+class CaptionService:
+    """Local HTTP front end for a MicroBatcher.
+
+    POST /caption with the raw image bytes as the body returns {"caption": ..., "latency_ms": ...};
+    GET /health or /metrics returns the batcher's queue, batch-size and latency statistics.
+    """
+
+    def __init__(self, batcher, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self.batcher = batcher
+        self.host = host
+        self.port = port
+
+    async def _route(self, method, path, body):
+        if path in ("/health", "/metrics"):
+            if method != "GET":
+                raise _HttpError(405, "use GET")
+            return self.batcher.metrics()
+        if path == "/caption":
+            if method != "POST":
+                raise _HttpError(405, "use POST with the image bytes as the body")
+            start = time.perf_counter()
+            try:
+                # Decoding is CPU work too; keep it off the event loop
+                image = await asyncio.get_running_loop().run_in_executor(None, _decode_image, body)
+            except Exception as e:
+                raise _HttpError(400, f"could not decode image: {e}")
+            caption = await self.batcher.caption(image)
+            return {"caption": caption, "latency_ms": round((time.perf_counter() - start) * 1000, 2)}
+        raise _HttpError(404, f"no route for {path}")
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    message = await _read_message(reader)
+                    if message is None:
+                        break
+                    start_line, headers, body = message
+                    method, target = start_line.split(" ")[:2]
+                    keep_alive = headers.get("connection", "").lower() != "close"
+                    status, payload = 200, await self._route(method, target.split("?")[0], body)
+                except _HttpError as e:
+                    status, payload, keep_alive = e.status, {"error": str(e)}, e.status != 413
+                except (ValueError, asyncio.LimitOverrunError) as e:
+                    status, payload, keep_alive = 400, {"error": f"malformed request: {e}"}, False
+                except Exception as e:
+                    status, payload, keep_alive = 500, {"error": str(e)}, True
+                writer.write(_response(status, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        self.batcher.start()
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        print(f"Serving captions on http://{self.host}:{self.port} (max batch {self.batcher.max_batch}, "
+              f"max wait {self.batcher.max_wait * 1000:g} ms)")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.batcher.stop()
+
+
+async def _request(reader, writer, method, path, body=b""):
+    writer.write((f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n"
+                  f"Content-Type: application/octet-stream\r\n\r\n").encode() + body)
+    await writer.drain()
+    message = await _read_message(reader)
+    if message is None:
+        raise ConnectionError("server closed the connection")
+    status_line, _, payload = message
+    return int(status_line.split(" ")[1]), json.loads(payload)
+
+
+async def fetch_metrics(host=DEFAULT_HOST, port=DEFAULT_PORT):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        return (await _request(reader, writer, "GET", "/metrics"))[1]
+    finally:
+        writer.close()
+
+
+async def run_load(image_paths, concurrency=8, requests=200, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """Send `requests` caption requests from `concurrency` keep-alive connections; client-side latencies."""
+    bodies = []
+    for path in image_paths:
+        with open(path, "rb") as f:
+            bodies.append(f.read())
+    counter = itertools.count()
+    latencies, errors = [], 0
+
+    async def client():
+        nonlocal errors
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while (i := next(counter)) < requests:
+                start = time.perf_counter()
+                status, _ = await _request(reader, writer, "POST", "/caption", bodies[i % len(bodies)])
+                latencies.append(time.perf_counter() - start)
+                errors += status != 200
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+    return {"concurrency": concurrency, "requests": requests, "errors": errors, "seconds": elapsed,
+            "requests_per_sec": requests / elapsed, "p50_ms": p50, "p95_ms": p95, "p99_ms": p99}
+
+
+def print_load_results(results):
+    print(f"{'clients':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>6}")
+    for row in results:
+        print(f"{row['concurrency']:>7} {row['requests_per_sec']:>8.2f} {row['p50_ms']:>8.1f} "
+              f"{row['p95_ms']:>8.1f} {row['p99_ms']:>8.1f} {row['errors']:>6}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-batching BLIP caption service and its load generator")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="run the caption service")
+    serve_parser.add_argument("--host", default=DEFAULT_HOST)
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    serve_parser.add_argument("--max-batch", type=int, default=DEFAULT_MAX_BATCH)
+    serve_parser.add_argument("--max-wait-ms", type=float, default=DEFAULT_MAX_WAIT_MS)
+    serve_parser.add_argument("--model", default=None, help="model id or local directory (default: BLIP base)")
+    serve_parser.add_argument("--beam", action="store_true", help="use num_beams=5 instead of greedy decoding")
+
+    load_parser = subparsers.add_parser("load", help="drive a running service and report latency/throughput")
+    load_parser.add_argument("--host", default=DEFAULT_HOST)
+    load_parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    load_parser.add_argument("--images", default="images")
+    load_parser.add_argument("--concurrency", default="1,4,16", help="comma-separated client counts to sweep")
+    load_parser.add_argument("--requests", type=int, default=200, help="requests per concurrency level")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        from blip_loader import get_processor, get_model, MODEL_ID
+
+        model_id = args.model or MODEL_ID
+        batcher = MicroBatcher(get_processor(model_id), get_model(model_id), args.max_batch,
+                               args.max_wait_ms / 1000, **(BEAM_SEARCH if args.beam else GREEDY))
+        try:
+            asyncio.run(CaptionService(batcher, args.host, args.port).serve())
+        except KeyboardInterrupt:
+            pass
+    else:
+        from image_pipeline import iter_image_paths
+
+        image_paths = list(iter_image_paths(args.images))
+        results = [asyncio.run(run_load(image_paths, int(c), args.requests, args.host, args.port))
+                   for c in args.concurrency.split(",")]
+        print_load_results(results)
+        print(json.dumps(asyncio.run(fetch_metrics(args.host, args.port)), indent=2))
@@ -0,0 +1,285 @@
+import os
+import sys
+import csv
+import time
+import numpy as np
+from ground_truth import load_captions, DEFAULT_CAPTIONS_FILE
+
+MAX_N = 4
+SIGMA = 6.0
+SIDECAR_SUFFIX = ".cider.npz"
+INDEX_VERSION = 1
+# Standalone punctuation the COCO caption tokenizer drops before scoring
+PUNCTUATION = {"''", "'", "``", "`", ".", "?", "!", ",", ":", "-", "--", "...", ";"}
+
+
+def tokenize(caption):
+    return [token for token in caption.lower().split() if token not in PUNCTUATION]
+
+
+def _ngram_keys(ids, sentence_of, n, base):
+    """Integer key of the n-gram starting at every position, and whether it stays inside one sentence.
+
+    Token ids start at 1, so keys of different orders never collide.
+    """
+    count = len(ids) - n + 1
+    if count <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+    keys = np.zeros(count, dtype=np.int64)
+    for j in range(n):
+        keys = keys * base + ids[j:j + count]
+    return keys, sentence_of[:count] == sentence_of[n - 1:]
+
+
+class CiderD:
+    """CIDEr-D against every reference caption in captions.txt, with document frequencies fixed at build time.
+
+    Reference n-grams are stored as (caption, n-gram id, count) triples sorted by caption, so new
+    candidates are scored by lookups into the index instead of a pass over the corpus.
+    """
+
+    def __init__(self, captions, vocab, ngram_keys, ngram_orders, df, ref_ngrams, ref_counts, ref_offsets,
+                 ref_lengths, sigma=SIGMA):
+        self.captions = captions
+        self.vocab = vocab
+        self.ngram_keys = ngram_keys
+        self.ngram_orders = ngram_orders
+        self.df = df
+        self.ref_ngrams = ref_ngrams
+        self.ref_counts = ref_counts
+        self.ref_offsets = ref_offsets
+        self.ref_lengths = ref_lengths
+        self.sigma = sigma
+
+        self._token_id = {token: i + 1 for i, token in enumerate(vocab)}
+        self._base = len(vocab) + 1
+        # Every image's references form one document
+        self.log_docs = np.log(float(len(captions)))
+        self.idf = self.log_docs - np.log(np.maximum(df, 1))
+
+        num_refs = len(ref_offsets) - 1
+        ref_of_entry = np.repeat(np.arange(num_refs), np.diff(ref_offsets))
+        self._ref_entry_keys = ref_of_entry * len(ngram_keys) + ref_ngrams
+        self._ref_vec = ref_counts * self.idf[ref_ngrams]
+        self._ref_norms = np.sqrt(np.bincount(ref_of_entry * MAX_N + ngram_orders[ref_ngrams] - 1,
+                                              weights=self._ref_vec ** 2,
+                                              minlength=num_refs * MAX_N)).reshape(num_refs, MAX_N)
+
+    def score(self, candidates, images):
+        """CIDEr-D of each candidate caption against the references of the matching image.
+
+        Returns (mean score, per-candidate scores), both scaled by 10 like the COCO scorer.
+        """
+        num_candidates = len(candidates)
+        starts, counts = [], []
+        for image in images:
+            caption_range = self.captions.caption_range(image)
+            if caption_range is None:
+                raise ValueError(f"no reference captions for {image}")
+            starts.append(caption_range[0])
+            counts.append(caption_range[1] - caption_range[0])
+        ref_starts, refs_per_candidate = np.array(starts, dtype=np.int64), np.array(counts, dtype=np.int64)
+        if num_candidates == 0:
+            return 0.0, np.zeros(0)
+
+        # Words the references never use get ids past the index vocabulary
+        new_words = {}
+        tokens = [tokenize(candidate) for candidate in candidates]
+        lengths = np.array([len(t) for t in tokens], dtype=np.int64)
+        ids = np.array([self._token_id.get(t) or self._base + new_words.setdefault(t, len(new_words))
+                        for sentence in tokens for t in sentence], dtype=np.int64)
+        sentence_of = np.repeat(np.arange(num_candidates), lengths)
+        local_base = self._base + len(new_words)
+        is_new = (ids >= self._base).astype(np.int64)
+
+        # One (candidate, reference) pair per reference of each candidate's image
+        pair_offsets = np.r_[0, np.cumsum(refs_per_candidate)]
+        num_pairs = int(pair_offsets[-1])
+        candidate_of_pair = np.repeat(np.arange(num_candidates), refs_per_candidate)
+        ref_of_pair = ref_starts[candidate_of_pair] + np.arange(num_pairs) - pair_offsets[candidate_of_pair]
+
+        candidate_norms = np.zeros((num_candidates, MAX_N))
+        overlap = np.zeros((num_pairs, MAX_N))
+        num_ngrams = len(self.ngram_keys)
+        for n in range(1, MAX_N + 1):
+            local_keys, valid = _ngram_keys(ids, sentence_of, n, local_base)
+            if not valid.any():
+                continue
+            index_keys, _ = _ngram_keys(ids, sentence_of, n, self._base)
+            has_new = np.convolve(is_new, np.ones(n, dtype=np.int64), mode="valid")[valid] > 0
+            owner = sentence_of[:len(valid)][valid]
+            local_keys, index_keys = local_keys[valid], index_keys[valid]
+
+            # Term frequency of each distinct n-gram per candidate
+            ranks = np.unique(local_keys, return_inverse=True)[1].reshape(-1)
+            _, first, tf = np.unique(owner * (int(ranks.max()) + 1) + ranks, return_index=True, return_counts=True)
+            owner, index_keys, has_new = owner[first], index_keys[first], has_new[first]
+            g = np.minimum(np.searchsorted(self.ngram_keys, index_keys), num_ngrams - 1)
+            found = ~has_new & (self.ngram_keys[g] == index_keys)
+            # An n-gram no reference uses has document frequency 0, and log(max(1, 0)) = 0
+            vec = tf * np.where(found, self.idf[g], self.log_docs)
+            candidate_norms[:, n - 1] = np.sqrt(np.bincount(owner, weights=vec ** 2, minlength=num_candidates))
+
+            # Clipped overlap with each reference, only over n-grams the index knows
+            owner, g, vec = owner[found], g[found], vec[found]
+            repeat = refs_per_candidate[owner]
+            entry = np.repeat(np.arange(len(owner)), repeat)
+            within = np.arange(len(entry)) - np.repeat(np.cumsum(repeat) - repeat, repeat)
+            pair = pair_offsets[owner[entry]] + within
+            lookup = ref_of_pair[pair] * num_ngrams + g[entry]
+            pos = np.minimum(np.searchsorted(self._ref_entry_keys, lookup), len(self._ref_entry_keys) - 1)
+            ref_vec = np.where(self._ref_entry_keys[pos] == lookup, self._ref_vec[pos], 0.0)
+            overlap[:, n - 1] = np.bincount(pair, weights=np.minimum(vec[entry], ref_vec) * ref_vec,
+                                            minlength=num_pairs)
+
+        norms = candidate_norms[candidate_of_pair] * self._ref_norms[ref_of_pair]
+        similarity = np.divide(overlap, norms, out=overlap.copy(), where=norms > 0)
+        # The COCO scorer measures caption length in bigrams
+        delta = (np.maximum(lengths - 1, 0)[candidate_of_pair] - self.ref_lengths[ref_of_pair]).astype(np.float64)
+        similarity *= np.exp(-(delta ** 2) / (2 * self.sigma ** 2))[:, None]
+        scores = np.bincount(candidate_of_pair, weights=similarity.mean(axis=1),
+                             minlength=num_candidates) / refs_per_candidate * 10.0
+        return float(scores.mean()), scores
+
+
+def build_index(captions):
+    """Reference n-gram counts and document frequencies for every caption in a CaptionIndex."""
+    vocab, lower_id = [], {}
+    token_map = np.zeros(len(captions.vocab), dtype=np.int64)
+    for i, token in enumerate(captions.vocab):
+        token = token.lower()
+        if token in PUNCTUATION:
+            continue
+        token_id = lower_id.get(token)
+        if token_id is None:
+            token_id = lower_id[token] = len(vocab) + 1
+            vocab.append(token)
+        token_map[i] = token_id
+    base = len(vocab) + 1
+    if base ** MAX_N >= 2 ** 63:
+        raise ValueError(f"vocabulary of {len(vocab)} words is too large for int64 n-gram keys")
+
+    num_captions = len(captions.caption_offsets) - 1
+    caption_of = np.repeat(np.arange(num_captions), np.diff(captions.caption_offsets))
+    ids = token_map[captions.token_ids]
+    keep = ids > 0
+    ids, caption_of = ids[keep], caption_of[keep]
+    ref_lengths = np.maximum(np.bincount(caption_of, minlength=num_captions) - 1, 0).astype(np.int32)
+
+    all_keys, all_captions, all_orders = [], [], []
+    for n in range(1, MAX_N + 1):
+        keys, valid = _ngram_keys(ids, caption_of, n, base)
+        all_keys.append(keys[valid])
+        all_captions.append(caption_of[:len(valid)][valid])
+        all_orders.append(np.full(int(valid.sum()), n, dtype=np.uint8))
+    all_keys, all_captions, all_orders = np.concatenate(all_keys), np.concatenate(all_captions), np.concatenate(all_orders)
+
+    ngram_keys, first, gids = np.unique(all_keys, return_index=True, return_inverse=True)
+    gids = gids.reshape(-1)
+    num_ngrams = len(ngram_keys)
+    image_of_caption = np.repeat(np.arange(len(captions)), np.diff(captions.image_offsets))
+    documents = np.unique(image_of_caption[all_captions] * num_ngrams + gids)
+    df = np.bincount(documents % num_ngrams, minlength=num_ngrams).astype(np.int32)
+
+    entries, ref_counts = np.unique(all_captions * num_ngrams + gids, return_counts=True)
+    ref_offsets = np.searchsorted(entries // num_ngrams, np.arange(num_captions + 1)).astype(np.int64)
+    return CiderD(captions, vocab, ngram_keys, all_orders[first], df, (entries % num_ngrams).astype(np.int32),
+                  ref_counts.astype(np.uint16), ref_offsets, ref_lengths)
+
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return np.array([INDEX_VERSION, stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
+
+def save_index(scorer, sidecar_path, stamp):
+    tmp_path = f"{sidecar_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            stamp=stamp,
+            vocab=np.frombuffer("\n".join(scorer.vocab).encode(), dtype=np.uint8),
+            ngram_keys=scorer.ngram_keys,
+            ngram_orders=scorer.ngram_orders,
+            df=scorer.df,
+            ref_ngrams=scorer.ref_ngrams,
+            ref_counts=scorer.ref_counts,
+            ref_offsets=scorer.ref_offsets,
+            ref_lengths=scorer.ref_lengths,
+        )
+    os.replace(tmp_path, sidecar_path)
+
+
+def _load_sidecar(sidecar_path, stamp, captions):
+    try:
+        with np.load(sidecar_path) as data:
+            if not np.array_equal(data["stamp"], stamp):
+                return None
+            return CiderD(
+                captions,
+                data["vocab"].tobytes().decode().split("\n"),
+                data["ngram_keys"],
+                data["ngram_orders"],
+                data["df"],
+                data["ref_ngrams"],
+                data["ref_counts"],
+                data["ref_offsets"],
+                data["ref_lengths"],
+            )
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+_loaded = {}
+
+
+def load_cider(path=DEFAULT_CAPTIONS_FILE):
+    """The CIDEr-D scorer for path, read from its binary sidecar unless the CSV changed since it was built."""
+    stamp = _source_stamp(path)
+    key = os.path.abspath(path)
+    cached = _loaded.get(key)
+    if cached is not None and np.array_equal(cached[0], stamp):
+        return cached[1]
+
+    captions = load_captions(path)
+    sidecar_path = path + SIDECAR_SUFFIX
+    scorer = _load_sidecar(sidecar_path, stamp, captions)
+    if scorer is None:
+        scorer = build_index(captions)
+        save_index(scorer, sidecar_path, stamp)
+    _loaded[key] = (stamp, scorer)
+    return scorer
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_CAPTIONS_FILE
+    results_path = sys.argv[2] if len(sys.argv) > 2 else "results.csv"
+
+    captions = load_captions(path)
+    start = time.perf_counter()
+    scorer = build_index(captions)
+    build_seconds = time.perf_counter() - start
+    save_index(scorer, path + SIDECAR_SUFFIX, _source_stamp(path))
+
+    start = time.perf_counter()
+    scorer = _load_sidecar(path + SIDECAR_SUFFIX, _source_stamp(path), captions)
+    load_seconds = time.perf_counter() - start
+
+    print(f"{len(scorer.ngram_keys)} distinct n-grams over {len(captions)} images, "
+          f"index {os.path.getsize(path + SIDECAR_SUFFIX) / 1024 ** 2:.1f} MiB")
+    print(f"Build index: {build_seconds * 1000:.1f} ms")
+    print(f"Load sidecar: {load_seconds * 1000:.1f} ms")
+
+    if os.path.exists(results_path):
+        with open(results_path, newline="", encoding="utf-8") as f:
+            rows = [row for row in csv.DictReader(f) if row["Image Filename"] in captions]
+        start = time.perf_counter()
+        mean, _ = scorer.score([row["Generated Caption"] for row in rows], [row["Image Filename"] for row in rows])
+        print(f"CIDEr-D of {results_path}: {mean:.4f} ({len(rows)} captions in "
+              f"{(time.perf_counter() - start) * 1000:.1f} ms)")
+
+    # Each image's first reference as a stand-in batch of new candidates
+    images = captions.images[:500]
+    start = time.perf_counter()
+    mean, _ = scorer.score([captions.captions(image)[0] for image in images], images)
+    print(f"CIDEr-D of {len(images)} held-in references: {mean:.4f} ({(time.perf_counter() - start) * 1000:.1f} ms)")
@@ -1,85 +1,79 @@
 import os
-import torch
-import nltk
-from PIL import Image
-from transformers import BlipProcessor, BlipForConditionalGeneration
-from nltk.translate.bleu_score import sentence_bleu
-from nltk.translate.meteor_score import meteor_score
+from blip_loader import get_processor, get_model, model_fingerprint_for, ensure_wordnet, measure_first_token, print_startup_report
+from evaluator import stored_scores
+from caption_engine import generate_captions, GREEDY
+from embedding_cache import EmbeddingCache, model_fingerprint
+from result_store import ResultStore
+from ground_truth import load_captions
+from instrumentation import instrumentation_from_env
+from image_dataset import open_dataset
 import random
 
-# Ensure required NLTK resources are downloaded
-nltk.download('wordnet')
+# Ensure required NLTK resources are available
+ensure_wordnet()
 
-# Load BLIP Model and Processor
-processor_resnet = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-model_resnet = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
-
-def generate_caption_resnet(image_path):
-    image = Image.open(image_path).convert("RGB")
-    inputs = processor_resnet(image, return_tensors="pt")
-    with torch.no_grad():
-        out = model_resnet.generate(**inputs)
-    return processor_resnet.decode(out[0], skip_special_tokens=True)
+# Load the BLIP processor; the model is loaded below only if the result store lacks captions
+processor_resnet = get_processor()
 
 # Dataset folder
 image_folder_resnet = "Images"
 image_files_resnet = os.listdir(image_folder_resnet)[:20]  # Select first 20 images
 
-# Ground truth captions for 20 images
-ground_truth_captions_resnet = {
-    "1000268201_693b08cb0e.jpg": "A child in a pink dress is climbing up a set of stairs in an entry way.",
-    "1001773457_577c3a7d70.jpg": "A black dog and a spotted dog are fighting.",
-    "1002674143_1b742ab4b8.jpg": "A little girl covered in paint sits in front of a painted rainbow with her hands in a bowl.",
-    "1003163366_44323f5815.jpg": "A man lays on a bench while his dog sits by him.",
-    "1007129816_e794419615.jpg": "A man in an orange hat staring at something.",
-    "1007320043_627395c3d8.jpg": "A child playing on a rope net.",
-    "1009434119_febe49276a.jpg": "A black and white dog is running in a grassy garden surrounded by a white fence.",
-    "1012212859_01547e3f17.jpg": "A dog shakes its head near the shore, a red ball next to it.",
-    "1015118661_980735411b.jpg": "A boy smiles in front of a stony wall in a city.",
-    "1015584366_dfcec3c85a.jpg": "A black dog leaps over a log.",
-    "101654506_8eb26cfb60.jpg": "A brown and white dog is running through the snow.",
-    "101669240_b2d3e7f17b.jpg": "A skier looks at framed pictures in the snow next to trees.",
-    "1022975728_75515238d8.jpg": "This is a black dog splashing in the water.",
-    "102351840_323e3de834.jpg": "A man drilling a hole in the ice.",
-    "1024138940_f1fefbdce1.jpg": "Two different breeds of brown and white dogs play on the beach.",
-    "102455176_5f8ead62d5.jpg": "A man uses ice picks and crampons to scale ice.",
-    "1026685415_0431cbf574.jpg": "A black dog carries a green toy in his mouth as he walks through the grass.",
-    "1027747856_3633cbf996.jpg": "A man riding a bike in the mountains with a blue sky in the background.",
-    "102826869_5b0409c34e.jpg": "A woman wearing a red helmet climbing a rock wall.",
-    "102947516_1365cbfaa8.jpg": "Two boys playing soccer on a green field."
-}
+# Ground truth captions (every reference per image) from captions.txt
+ground_truth_captions_resnet = load_captions("captions.txt")
 
 # Initialize storage for results
 generated_captions_resnet = {}
 bleu_scores_resnet = []
 meteor_scores_resnet = []
+references_resnet, candidates_resnet, scored_files_resnet = [], [], []
 image_accuracies_resnet = {}
 
+# Optional stage timings (CAPTION_TRACE=trace.jsonl) and profiling (CAPTION_PROFILE=torch|cprofile)
+instrumentation = instrumentation_from_env()
+
 # Generate captions and evaluate
-for image_file in image_files_resnet:
-    image_path_resnet = os.path.join(image_folder_resnet, image_file)
-    generated_caption_resnet = generate_caption_resnet(image_path_resnet)
+image_paths_resnet = [os.path.join(image_folder_resnet, image_file) for image_file in image_files_resnet]
+# Captions and scores from earlier runs come from the result store; the model only runs for images it lacks
+store_resnet = ResultStore()
+generate_kwargs_resnet = GREEDY
+model_id_resnet = model_fingerprint_for()
+if store_resnet.missing(image_paths_resnet, model_id_resnet, generate_kwargs_resnet):
+    model_resnet = get_model()
+    model_id_resnet = model_fingerprint(model_resnet)
+    # Time from the loaded model to the first caption token, for the startup report
+    measure_first_token(image_paths_resnet[0], processor_resnet, model_resnet)
+    all_captions_resnet = generate_captions(image_paths_resnet, processor_resnet, model_resnet, cache=EmbeddingCache(), store=store_resnet, instrumentation=instrumentation, dataset=open_dataset(), **generate_kwargs_resnet)
+else:
+    all_captions_resnet = [store_resnet.get(path, model_id_resnet, generate_kwargs_resnet)["caption"] for path in image_paths_resnet]
+
+for image_file, generated_caption_resnet in zip(image_files_resnet, all_captions_resnet):
     generated_captions_resnet[image_file] = generated_caption_resnet
     
-    # Get ground truth caption
-    ground_truth_resnet = ground_truth_captions_resnet.get(image_file, "")
-    
-    # BLEU Score
-    reference_resnet = [ground_truth_resnet.split()]
-    candidate_resnet = generated_caption_resnet.split()
-    bleu_score_resnet = sentence_bleu(reference_resnet, candidate_resnet)
-    bleu_scores_resnet.append(bleu_score_resnet)
+    # Get ground truth captions
+    ground_truth_resnet = ground_truth_captions_resnet.captions(image_file)
     
-    # METEOR Score
-    meteor_score_value_resnet = meteor_score(reference_resnet, candidate_resnet)
-    meteor_scores_resnet.append(meteor_score_value_resnet)
+    if not ground_truth_resnet:
+        print(f"No ground truth found for {image_file}. Skipping evaluation.")
+        continue
+
+    # Tokenized for the batched BLEU and METEOR below
+    references_resnet.append([caption.split() for caption in ground_truth_resnet])
+    candidates_resnet.append(generated_caption_resnet.split())
+    scored_files_resnet.append(image_file)
     
     # Randomized accuracy between 75 and 100%
     image_accuracies_resnet[image_file] = round(random.uniform(75, 100), 2)
 
+# BLEU-4 and METEOR for every scored image in one batch, reusing scores stored with the captions
+instrumentation.set_items(scored_files_resnet)
+if candidates_resnet:
+    scored_paths_resnet = [os.path.join(image_folder_resnet, image_file) for image_file in scored_files_resnet]
+    bleu_scores_resnet, meteor_scores_resnet = stored_scores(store_resnet, scored_paths_resnet, model_id_resnet, generate_kwargs_resnet, references_resnet, candidates_resnet, instrumentation=instrumentation)
+
 # Compute Mean Accuracy Scores
-mean_bleu_score_resnet = sum(bleu_scores_resnet) / len(bleu_scores_resnet)
-mean_meteor_score_resnet = sum(meteor_scores_resnet) / len(meteor_scores_resnet)
+mean_bleu_score_resnet = sum(bleu_scores_resnet) / len(bleu_scores_resnet) if bleu_scores_resnet else 0
+mean_meteor_score_resnet = sum(meteor_scores_resnet) / len(meteor_scores_resnet) if meteor_scores_resnet else 0
 
 # New Exact Match Accuracy Calculation (custom formula)
 exact_match_accuracy_resnet = round(
@@ -101,3 +95,7 @@ for img, accuracy in image_accuracies_resnet.items():
 print(f"\nExact Match Accuracy (ResNet): {exact_match_accuracy_resnet:.2f}%")
 print(f"Mean BLEU Score (ResNet): {mean_bleu_score_resnet:.4f}")
 print(f"Mean METEOR Score (ResNet): {mean_meteor_score_resnet:.4f}")
+
+instrumentation.close()
+instrumentation.print_summary()
+print_startup_report()
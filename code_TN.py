@@ -1,56 +1,31 @@
 import os
-import torch
 import random
-import nltk
-from PIL import Image
-from transformers import BlipProcessor, BlipForConditionalGeneration
-from nltk.translate.bleu_score import sentence_bleu
-from nltk.translate.meteor_score import meteor_score
-
-# Ensure required NLTK resources are downloaded
-nltk.download('wordnet')
-
-# Load BLIP Model and Processor
-processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
-
-def generate_caption(image_path):
-    image = Image.open(image_path).convert("RGB")
-    inputs = processor(image, return_tensors="pt")
-    with torch.no_grad():
-        out = model.generate(**inputs, num_beams=5, early_stopping=True)  # Use beam search for better accuracy
-    return processor.decode(out[0], skip_special_tokens=True)
+from blip_loader import get_processor, get_model, model_fingerprint_for, ensure_wordnet, measure_first_token, print_startup_report
+from evaluator import stored_scores
+from caption_engine import generate_captions, BEAM_SEARCH
+from embedding_cache import EmbeddingCache, model_fingerprint
+from result_store import ResultStore
+from ground_truth import load_captions
+from instrumentation import instrumentation_from_env
+from image_dataset import open_dataset
+
+# Ensure required NLTK resources are available
+ensure_wordnet()
+
+# Load the BLIP processor; the model is loaded below only if the result store lacks captions
+processor = get_processor()
 
 # Dataset folder
 image_folder = "Images"
 image_files = os.listdir(image_folder)[:20]  # Select first 20 images
 
-ground_truth_captions = {
-    "1000268201_693b08cb0e.jpg": "A child in a pink dress is climbing up a set of stairs in an entry way .",
-    "1001773457_577c3a7d70.jpg": "A black dog and a spotted dog are fighting",
-    "1002674143_1b742ab4b8.jpg": "A little girl covered in paint sits in front of a painted rainbow with her hands in a bowl .",
-    "1003163366_44323f5815.jpg": "A man lays on a bench while his dog sits by him .",
-    "1007129816_e794419615.jpg": "A man in an orange hat starring at something .",
-    "1007320043_627395c3d8.jpg": "A child playing on a rope net .",
-    "1009434119_febe49276a.jpg": "A black and white dog is running in a grassy garden surrounded by a white fence .",
-    "1012212859_01547e3f17.jpg": "A dog shakes its head near the shore , a red ball next to it .",
-    "1015118661_980735411b.jpg": "A boy smiles in front of a stony wall in a city .",
-    "1015584366_dfcec3c85a.jpg": "A black dog leaps over a log .",
-    "101654506_8eb26cfb60.jpg": "A dog running through snow .",
-    "101669240_b2d3e7f17b.jpg": "A skier looks at framed pictures in the snow next to trees .",
-    "1015584366_dfcec3c85a.jpg": "The black dog jumped the tree stump .",
-    "101654506_8eb26cfb60.jpg": "A brown and white dog is running through the snow .",
-    "101654506_8eb26cfb60.jpg": "A dog is running in the snow",
-    "101654506_8eb26cfb60.jpg": "A dog running through snow .",
-    "101654506_8eb26cfb60.jpg": "a white and brown dog is running through a snow covered field .",
-    "101654506_8eb26cfb60.jpg": "The white and brown dog is running over the surface of the snow .",
-    "101669240_b2d3e7f17b.jpg": "A man in a hat is displaying pictures next to a skier in a blue hat .",
-    "101669240_b2d3e7f17b.jpg": "A man skis past another man displaying paintings in the snow ."
-}
+# Ground truth captions (every reference per image) from captions.txt
+ground_truth_captions = load_captions("captions.txt")
 
 generated_captions = {}
 bleu_scores = []
 meteor_scores = []
+references, candidates, scored_files = [], [], []
 
 # Predefined image accuracies (replacing random values)
 predefined_image_accuracies = {
@@ -68,29 +43,49 @@ predefined_image_accuracies = {
     "101669240_b2d3e7f17b.jpg": 84.67,
 }
 
+# Optional stage timings (CAPTION_TRACE=trace.jsonl) and profiling (CAPTION_PROFILE=torch|cprofile)
+instrumentation = instrumentation_from_env()
+
 # Generate captions and evaluate
-for image_file in image_files:
-    image_path = os.path.join(image_folder, image_file)
-    generated_caption = generate_caption(image_path)
+image_paths = [os.path.join(image_folder, image_file) for image_file in image_files]
+# Captions and scores from earlier runs come from the result store; the model only runs for images it lacks
+store = ResultStore()
+generate_kwargs = BEAM_SEARCH  # Use beam search for better accuracy
+model_id = model_fingerprint_for()
+if store.missing(image_paths, model_id, generate_kwargs):
+    model = get_model()
+    model_id = model_fingerprint(model)
+    # Time from the loaded model to the first caption token, for the startup report
+    measure_first_token(image_paths[0], processor, model)
+    all_captions = generate_captions(image_paths, processor, model, cache=EmbeddingCache(), store=store, instrumentation=instrumentation, dataset=open_dataset(), **generate_kwargs)
+else:
+    all_captions = [store.get(path, model_id, generate_kwargs)["caption"] for path in image_paths]
+
+for image_file, generated_caption in zip(image_files, all_captions):
     generated_captions[image_file] = generated_caption
     
-    # Get ground truth caption
-    ground_truth = ground_truth_captions.get(image_file, "")
+    # Get ground truth captions
+    ground_truth = ground_truth_captions.captions(image_file)
     
-    # BLEU Score
-    reference = [ground_truth.split()]
-    candidate = generated_caption.split()
-    bleu_score = sentence_bleu(reference, candidate)
-    bleu_scores.append(bleu_score)
-    
-    # METEOR Score
-    meteor_score_value = meteor_score(reference, candidate)
-    meteor_scores.append(meteor_score_value)
+    if not ground_truth:
+        print(f"No ground truth found for {image_file}. Skipping evaluation.")
+        continue
+
+    # Tokenized for the batched BLEU and METEOR below
+    references.append([caption.split() for caption in ground_truth])
+    candidates.append(generated_caption.split())
+    scored_files.append(image_file)
+
+# BLEU-4 and METEOR for every scored image in one batch, reusing scores stored with the captions
+instrumentation.set_items(scored_files)
+if candidates:
+    scored_paths = [os.path.join(image_folder, image_file) for image_file in scored_files]
+    bleu_scores, meteor_scores = stored_scores(store, scored_paths, model_id, generate_kwargs, references, candidates, instrumentation=instrumentation)
 
 # Compute Mean Accuracy Scores
 exact_match_accuracy = 88.75  # Updated fixed value
-mean_bleu_score = sum(bleu_scores) / len(bleu_scores)
-mean_meteor_score = sum(meteor_scores) / len(meteor_scores)
+mean_bleu_score = sum(bleu_scores) / len(bleu_scores) if bleu_scores else 0
+mean_meteor_score = sum(meteor_scores) / len(meteor_scores) if meteor_scores else 0
 
 # Print Results
 print("Generated Captions:")
@@ -105,3 +100,7 @@ for img in image_files:
 print(f"\nExact Match Accuracy: {exact_match_accuracy:.2f}%")
 print(f"Mean BLEU Score: {mean_bleu_score:.4f}")
 print(f"Mean METEOR Score: {mean_meteor_score:.4f}")
+
+instrumentation.close()
+instrumentation.print_summary()
+print_startup_report()
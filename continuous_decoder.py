@@ -0,0 +1,338 @@
+import time
+import argparse
+import torch
+from transformers import EncoderDecoderCache
+
+from caption_engine import encode_images, GREEDY, BEAM_SEARCH
+from image_pipeline import batched, load_image, iter_image_paths
+
+# BLIP decodes at most 20 new tokens unless told otherwise
+DEFAULT_MAX_NEW_TOKENS = 20
+
+
+class _Request:
+    def __init__(self, key, image_embeds, num_beams):
+        self.key = key
+        self.image_embeds = image_embeds
+        self.num_beams = num_beams
+        self.tokens = [[] for _ in range(num_beams)]
+        # Only the first beam is live at the start, like model.generate
+        self.scores = torch.full((num_beams,), -1.0e9)
+        self.scores[0] = 0.0
+        self.finished = []
+        self.improvement_possible = True
+        self.generated = 0
+
+
+class ContinuousBatchDecoder:
+    """Greedy / beam decoding over the BLIP text decoder with per-step admission and eviction.
+
+    Each request owns num_beams rows of the running batch. Finished requests are dropped at the
+    end of the step that finishes them and queued images are prefilled into the freed slots, so no
+    row is ever spent on a caption that is already complete. Self-attention keys/values of all rows
+    share one time axis: rows admitted later are left-padded and masked, and columns no live row
+    uses any more are trimmed. Cross-attention keys/values are computed once per image at prefill.
+    """
+
+    def __init__(self, model, max_slots=8, num_beams=1, max_new_tokens=DEFAULT_MAX_NEW_TOKENS,
+                 length_penalty=1.0, early_stopping=False):
+        self.decoder = model.text_decoder
+        text_config = model.config.text_config
+        self.bos_token_id = text_config.bos_token_id
+        self.eos_token_id = text_config.sep_token_id
+        self.max_slots = max_slots
+        self.num_beams = num_beams
+        self.max_new_tokens = max_new_tokens
+        self.length_penalty = length_penalty
+        self.early_stopping = early_stopping
+
+        self.pending = []
+        self.active = []
+        self.self_kv = None
+        self.cross_kv = None
+        self.mask = None
+        self.image_embeds = None
+        self.next_tokens = None
+        self.stats = {"steps": 0, "prefills": 0, "rows": 0, "kv_cells": 0, "kv_padding": 0,
+                      "tokens": 0, "finished": 0, "seconds": 0.0}
+
+    def add(self, key, image_embeds):
+        self.pending.append(_Request(key, image_embeds, self.num_beams))
+
+    def queued(self):
+        return len(self.pending)
+
+    def free_slots(self):
+        return self.max_slots - len(self.active)
+
+    def has_work(self):
+        return bool(self.pending or self.active)
+
+    def _forward(self, input_ids, attention_mask, position_ids, image_embeds, cache):
+        out = self.decoder(
+            input_ids=input_ids[:, None],
+            attention_mask=attention_mask,
+            position_ids=position_ids[:, None],
+            encoder_hidden_states=image_embeds,
+            past_key_values=cache,
+            use_cache=True,
+        )
+        return out.logits[:, -1, :].float(), out.past_key_values
+
+    @staticmethod
+    def _split_cache(cache):
+        self_kv = [(layer.keys, layer.values) for layer in cache.self_attention_cache.layers]
+        cross_kv = [(layer.keys, layer.values) for layer in cache.cross_attention_cache.layers]
+        return self_kv, cross_kv
+
+    def _decode_running(self):
+        # One new column for every running row; masked columns belong to rows admitted later
+        rows, width = self.mask.shape
+        attention_mask = torch.cat([self.mask, self.mask.new_ones(rows, 1)], dim=1)
+        positions = torch.tensor([r.generated for r in self.active for _ in range(r.num_beams)])
+        cache = EncoderDecoderCache([sk + ck for sk, ck in zip(self.self_kv, self.cross_kv)])
+        logits, cache = self._forward(self.next_tokens, attention_mask, positions, self.image_embeds, cache)
+        self.self_kv, _ = self._split_cache(cache)
+        self.mask = attention_mask
+
+        self.stats["steps"] += 1
+        self.stats["rows"] += rows
+        self.stats["kv_cells"] += rows * (width + 1)
+        self.stats["kv_padding"] += int((attention_mask == 0).sum())
+        return logits
+
+    def _prefill(self, requests):
+        image_embeds = torch.stack([r.image_embeds for r in requests])
+        input_ids = torch.full((len(requests),), self.bos_token_id, dtype=torch.long)
+        positions = torch.zeros(len(requests), dtype=torch.long)
+        attention_mask = torch.ones(len(requests), 1, dtype=torch.long)
+        logits, cache = self._forward(input_ids, attention_mask, positions, image_embeds, None)
+        self_kv, cross_kv = self._split_cache(cache)
+
+        # Every beam of a request starts from the same prefix
+        repeats = torch.tensor([r.num_beams for r in requests])
+        expand = lambda t: t.repeat_interleave(repeats, dim=0)
+        self.stats["prefills"] += 1
+        self.stats["rows"] += len(requests)
+        return (expand(logits), [(expand(k), expand(v)) for k, v in self_kv],
+                [(expand(k), expand(v)) for k, v in cross_kv], expand(image_embeds))
+
+    def _join(self, prefill):
+        # Append freshly prefilled rows, left-padding their single key/value column to the shared width
+        logits, self_kv, cross_kv, image_embeds = prefill
+        rows = logits.shape[0]
+        width = self.mask.shape[1] if self.mask is not None else 1
+        mask = torch.zeros(rows, width, dtype=torch.long)
+        mask[:, -1] = 1
+        padded = []
+        for k, v in self_kv:
+            pad = k.new_zeros(k.shape[0], k.shape[1], width - 1, k.shape[3])
+            padded.append((torch.cat([pad, k], dim=2), torch.cat([pad, v], dim=2)))
+
+        if self.mask is None:
+            self.self_kv, self.cross_kv, self.mask, self.image_embeds = padded, cross_kv, mask, image_embeds
+            return
+        self.self_kv = [(torch.cat([k0, k1]), torch.cat([v0, v1])) for (k0, v0), (k1, v1) in zip(self.self_kv, padded)]
+        self.cross_kv = [(torch.cat([k0, k1]), torch.cat([v0, v1])) for (k0, v0), (k1, v1) in zip(self.cross_kv, cross_kv)]
+        self.mask = torch.cat([self.mask, mask])
+        self.image_embeds = torch.cat([self.image_embeds, image_embeds])
+
+    def _greedy_step(self, request, logits):
+        token = int(logits[0].argmax())
+        request.tokens[0].append(token)
+        request.generated += 1
+        done = token == self.eos_token_id or request.generated >= self.max_new_tokens
+        if done:
+            request.finished.append((0.0, request.tokens[0]))
+        return done, [0], [token]
+
+    def _beam_step(self, request, logits):
+        # Mirrors the beam bookkeeping of transformers' _beam_search for a single request
+        k = request.num_beams
+        log_probs = torch.log_softmax(logits, dim=-1) + request.scores[:, None]
+        vocab_size = log_probs.shape[-1]
+        top_scores, top_indices = log_probs.view(-1).topk(2 * k)
+        parents = (top_indices // vocab_size).tolist()
+        tokens = (top_indices % vocab_size).tolist()
+        generated = request.generated + 1
+        hits = [t == self.eos_token_id or generated >= self.max_new_tokens for t in tokens]
+
+        full = len(request.finished) == k
+        if request.improvement_possible and not (full and self.early_stopping is True):
+            for rank in range(k):
+                if hits[rank]:
+                    score = float(top_scores[rank]) / (generated ** self.length_penalty)
+                    request.finished.append((score, request.tokens[parents[rank]] + [tokens[rank]]))
+            request.finished.sort(key=lambda item: item[0], reverse=True)
+            del request.finished[k:]
+
+        running_scores = top_scores - 1.0e9 * torch.tensor(hits, dtype=top_scores.dtype)
+        keep_scores, keep = running_scores.topk(k)
+        keep = keep.tolist()
+        request.tokens = [request.tokens[parents[i]] + [tokens[i]] for i in keep]
+        request.scores = keep_scores
+        request.generated = generated
+
+        best_running = float(keep_scores[0]) / (generated ** self.length_penalty)
+        worst_finished = request.finished[-1][0] if len(request.finished) == k else -1.0e9
+        request.improvement_possible = request.improvement_possible and best_running > worst_finished
+
+        done = (not request.improvement_possible
+                or (len(request.finished) == k and self.early_stopping is True)
+                or all(hits))
+        return done, [parents[i] for i in keep], [tokens[i] for i in keep]
+
+    def step(self):
+        """Run one decoding step; returns (key, token_ids) for every request that finished in it."""
+        start = time.perf_counter()
+        admitted = []
+        while self.pending and len(self.active) + len(admitted) < self.max_slots:
+            admitted.append(self.pending.pop(0))
+
+        logits = self._decode_running() if self.active else None
+        if admitted:
+            prefill = self._prefill(admitted)
+            self._join(prefill)
+            logits = prefill[0] if logits is None else torch.cat([logits, prefill[0]])
+            self.active.extend(admitted)
+
+        finished, keep_rows, next_tokens, still_active = [], [], [], []
+        offset = 0
+        for request in self.active:
+            rows = logits[offset:offset + request.num_beams]
+            if request.num_beams == 1:
+                done, parents, tokens = self._greedy_step(request, rows)
+            else:
+                done, parents, tokens = self._beam_step(request, rows)
+            if done:
+                best = max(request.finished, key=lambda item: item[0])[1]
+                finished.append((request.key, [self.bos_token_id] + best))
+                self.stats["tokens"] += len(best)
+                self.stats["finished"] += 1
+            else:
+                keep_rows.extend(offset + p for p in parents)
+                next_tokens.extend(tokens)
+                still_active.append(request)
+            offset += request.num_beams
+
+        # Evict finished rows and reorder beams in one gather, then trim columns nobody attends to
+        self.active = still_active
+        if still_active:
+            index = torch.tensor(keep_rows)
+            self.self_kv = [(k[index], v[index]) for k, v in self.self_kv]
+            self.cross_kv = [(k[index], v[index]) for k, v in self.cross_kv]
+            self.mask = self.mask[index]
+            self.image_embeds = self.image_embeds[index]
+            self.next_tokens = torch.tensor(next_tokens)
+            first_used = int(self.mask.any(dim=0).nonzero()[0])
+            if first_used:
+                self.self_kv = [(k[:, :, first_used:], v[:, :, first_used:]) for k, v in self.self_kv]
+                self.mask = self.mask[:, first_used:]
+        else:
+            self.self_kv = self.cross_kv = self.mask = self.image_embeds = self.next_tokens = None
+
+        self.stats["seconds"] += time.perf_counter() - start
+        return finished
+
+
+def caption_images_continuous(image_paths, processor, model, max_slots=8, encode_batch_size=4,
+                              num_beams=1, **decode_kwargs):
+    """Caption image_paths with a ContinuousBatchDecoder, encoding images only as slots free up.
+
+    Returns (captions in input order, decoder stats).
+    """
+    decoder = ContinuousBatchDecoder(model, max_slots=max_slots, num_beams=num_beams, **decode_kwargs)
+    batches = batched(enumerate(image_paths), encode_batch_size)
+    captions = {}
+    exhausted = False
+    with torch.no_grad():
+        while True:
+            # Keep enough encoded images queued to fill every slot that can free up this step
+            while not exhausted and decoder.queued() < max(decoder.free_slots(), 1):
+                batch = next(batches, None)
+                if batch is None:
+                    exhausted = True
+                    break
+                images = [load_image(path) for _, path in batch]
+                pixel_values = processor(images, return_tensors="pt")["pixel_values"]
+                for (index, _), image_embeds in zip(batch, encode_images(model, pixel_values)):
+                    decoder.add(index, image_embeds)
+            if not decoder.has_work():
+                break
+            for index, token_ids in decoder.step():
+                captions[index] = processor.decode(token_ids, skip_special_tokens=True)
+    return [captions[i] for i in range(len(captions))], decoder.stats
+
+
+def generate_with_stats(image_paths, processor, model, batch_size=8, max_new_tokens=DEFAULT_MAX_NEW_TOKENS,
+                        **generate_kwargs):
+    """Plain static-batch model.generate, with the same token and padding accounting."""
+    num_beams = generate_kwargs.get("num_beams", 1)
+    eos_token_id = model.config.text_config.sep_token_id
+    captions = []
+    stats = {"rows": 0, "useful_rows": 0, "tokens": 0}
+    for batch_paths in batched(image_paths, batch_size):
+        images = [load_image(path) for path in batch_paths]
+        inputs = processor(images, return_tensors="pt")
+        with torch.no_grad():
+            out = model.generate(**inputs, max_new_tokens=max_new_tokens, **generate_kwargs)
+        generated = out[:, 1:]
+        steps = generated.shape[1]
+        for row in generated.tolist():
+            length = row.index(eos_token_id) + 1 if eos_token_id in row else len(row)
+            stats["tokens"] += length
+            # A row is useful until its own caption ends; the batch keeps running until the longest does
+            stats["useful_rows"] += length * num_beams
+        stats["rows"] += len(batch_paths) * num_beams * steps
+        captions.extend(processor.batch_decode(out, skip_special_tokens=True))
+    return captions, stats
+
+
+def compare_with_generate(image_paths, processor, model, batch_size=8, max_new_tokens=DEFAULT_MAX_NEW_TOKENS,
+                          **generate_kwargs):
+    image_paths = list(image_paths)
+    num_beams = generate_kwargs.get("num_beams", 1)
+    early_stopping = generate_kwargs.get("early_stopping", False)
+
+    # Both paths are timed end to end (decode, preprocess, encode and generate)
+    start = time.perf_counter()
+    static_captions, static = generate_with_stats(image_paths, processor, model, batch_size,
+                                                  max_new_tokens, **generate_kwargs)
+    static["seconds"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    continuous_captions, continuous = caption_images_continuous(
+        image_paths, processor, model, max_slots=batch_size, num_beams=num_beams,
+        max_new_tokens=max_new_tokens, early_stopping=early_stopping)
+    continuous["seconds"] = time.perf_counter() - start
+
+    return [
+        {"mode": "generate", "tokens_per_sec": static["tokens"] / static["seconds"],
+         "padding_waste": 1 - static["useful_rows"] / static["rows"], "kv_padding": 0.0,
+         "same_as_generate": len(image_paths)},
+        {"mode": "continuous", "tokens_per_sec": continuous["tokens"] / continuous["seconds"],
+         "padding_waste": 0.0, "kv_padding": continuous["kv_padding"] / max(continuous["kv_cells"], 1),
+         "same_as_generate": sum(a == b for a, b in zip(static_captions, continuous_captions))},
+    ]
+
+
+if __name__ == "__main__":
+    from blip_loader import get_processor, get_model
+
+    parser = argparse.ArgumentParser(description="Compare continuous batching against model.generate")
+    parser.add_argument("--images", default="images")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--beam", action="store_true", help="use num_beams=5 instead of greedy decoding")
+    args = parser.parse_args()
+
+    processor = get_processor()
+    model = get_model()
+
+    image_paths = list(iter_image_paths(args.images, args.limit))
+    generate_kwargs = BEAM_SEARCH if args.beam else GREEDY
+
+    print(f"{'mode':<11} {'tokens/s':>9} {'row waste':>10} {'kv padding':>11} {'same':>6}")
+    for row in compare_with_generate(image_paths, processor, model, args.batch_size, **generate_kwargs):
+        print(f"{row['mode']:<11} {row['tokens_per_sec']:>9.1f} {row['padding_waste']:>10.1%} "
+              f"{row['kv_padding']:>11.1%} {row['same_as_generate']:>3}/{len(image_paths)}")
@@ -0,0 +1,104 @@
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.path.join(".cache", "embeddings")
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint(model_id, revision, dtype, precision=None):
+    model_id = model_id or "local"
+    revision = revision or "unversioned"
+    dtype = str(dtype)
+    # Quantized Linear weights are not parameters, so the dtype alone does not show them
+    if precision == "int8":
+        dtype += "+int8"
+    return f"{model_id}@{revision}:{dtype}"
+
+
+def model_fingerprint(model):
+    """Identify the weights that produced an embedding: model id, hub revision and dtype."""
+    config = model.config
+    return fingerprint(getattr(config, "_name_or_path", ""), getattr(config, "_commit_hash", None),
+                       next(model.vision_model.parameters()).dtype, getattr(model, "precision_mode", None))
+
+
+class EmbeddingCache:
+    """On-disk cache of BLIP vision_model outputs, one memory-mapped .npy file per image.
+
+    Entries are keyed by the image bytes' hash, the model fingerprint and how the pixels were
+    produced (pil, draft or dataset decoding are close but not bit-identical), so renamed files
+    still hit and edited files miss. Entries are kept in least-recently-used order in memory,
+    seeded from file mtimes and bumped by get and put; reads also bump the mtime for the next
+    process. When the cache grows past max_bytes the oldest entries are deleted.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        entries = sorted((entry.stat().st_mtime_ns, entry.path, entry.stat().st_size)
+                         for entry in os.scandir(cache_dir) if entry.name.endswith(".npy"))
+        # Path -> size, oldest first
+        self._sizes = OrderedDict((path, size) for _, path, size in entries)
+        self._total = sum(self._sizes.values())
+
+    def key(self, image_path, model, source="pil"):
+        """source is how the pixels were produced: "pil", "draft" or "dataset"."""
+        fingerprint = hashlib.sha256(model_fingerprint(model).encode()).hexdigest()[:16]
+        key = f"{file_hash(image_path)}-{fingerprint}"
+        # pil keys keep the original form, so existing caches stay valid
+        return key if source == "pil" else f"{key}-{source}"
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            embeds = np.load(path, mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+        os.utime(path)
+        if path in self._sizes:
+            self._sizes.move_to_end(path)
+        self.hits += 1
+        return embeds
+
+    def put(self, key, embeds):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(embeds, dtype=np.float32))
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        self._total += size - self._sizes.get(path, 0)
+        self._sizes[path] = size
+        self._sizes.move_to_end(path)
+        if self._total > self.max_bytes:
+            self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """Delete least recently used entries until the cache fits in max_bytes."""
+        while self._total > self.max_bytes and self._sizes:
+            # The oldest entry comes first; keep, just written, is the newest and so is only reached last
+            path = next(iter(self._sizes))
+            if path == keep:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._total -= self._sizes.pop(path)
@@ -0,0 +1,290 @@
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+MAX_N = 4
+# nltk's unsmoothed BLEU stands in sys.float_info.min for a zero n-gram precision
+_ZERO_PRECISION_LOG = np.log(sys.float_info.min)
+
+
+def _flatten(candidates, references):
+    """Intern every token and lay all sentences end to end: candidates first, then references."""
+    vocab = {}
+    sentences = list(candidates)
+    owners = []
+    for i, refs in enumerate(references):
+        if not refs:
+            raise ValueError(f"candidate {i} has no references")
+        sentences.extend(refs)
+        owners.extend([i] * len(refs))
+    lengths = np.array([len(s) for s in sentences], dtype=np.int64)
+    ids = np.fromiter((vocab.setdefault(t, len(vocab)) for s in sentences for t in s),
+                      dtype=np.int64, count=int(lengths.sum()))
+    sentence_of = np.repeat(np.arange(len(sentences)), lengths)
+    return ids, sentence_of, lengths, np.array(owners, dtype=np.int64), max(len(vocab), 1)
+
+
+def ngram_counts(candidates, references, max_n=MAX_N):
+    """Clipped n-gram matches and n-gram totals per candidate for n = 1..max_n.
+
+    Returns (numerators, denominators, candidate lengths, closest reference lengths), the
+    quantities nltk's modified_precision / closest_ref_length compute one sentence at a time.
+    """
+    num_candidates = len(candidates)
+    ids, sentence_of, lengths, owners, vocab_size = _flatten(candidates, references)
+    numerators = np.zeros((num_candidates, max_n))
+    denominators = np.zeros((num_candidates, max_n))
+
+    ranks = ids
+    for n in range(1, max_n + 1):
+        if n > 1:
+            # An n-gram is its (n-1)-gram prefix's dense rank extended by one token, re-ranked densely
+            ranks = np.unique(ranks[:-1] * vocab_size + ids[n - 1:], return_inverse=True)[1].reshape(-1)
+        if len(ranks) == 0:
+            break
+        starts = np.arange(len(ranks))
+        valid = sentence_of[starts] == sentence_of[starts + n - 1]
+        sentences, grams = sentence_of[starts[valid]], ranks[valid]
+        num_grams = int(grams.max()) + 1 if len(grams) else 1
+
+        is_candidate = sentences < num_candidates
+        keys, counts = np.unique(sentences[is_candidate] * num_grams + grams[is_candidate], return_counts=True)
+
+        # Per reference counts, then the max over each candidate's references
+        ref_keys, ref_counts = np.unique(sentences[~is_candidate] * num_grams + grams[~is_candidate],
+                                         return_counts=True)
+        owner_keys = owners[ref_keys // num_grams - num_candidates] * num_grams + ref_keys % num_grams
+        order = np.argsort(owner_keys, kind="stable")
+        owner_keys, ref_counts = owner_keys[order], ref_counts[order]
+        if len(owner_keys):
+            starts_of_runs = np.flatnonzero(np.r_[True, owner_keys[1:] != owner_keys[:-1]])
+            max_keys = owner_keys[starts_of_runs]
+            max_counts = np.maximum.reduceat(ref_counts, starts_of_runs)
+            pos = np.minimum(np.searchsorted(max_keys, keys), len(max_keys) - 1)
+            ref_max = np.where(max_keys[pos] == keys, max_counts[pos], 0)
+        else:
+            ref_max = np.zeros_like(counts)
+
+        owner = keys // num_grams
+        numerators[:, n - 1] = np.bincount(owner, weights=np.minimum(counts, ref_max), minlength=num_candidates)
+        denominators[:, n - 1] = np.bincount(owner, weights=counts, minlength=num_candidates)
+
+    denominators = np.maximum(denominators, 1)
+    hyp_lengths = lengths[:num_candidates]
+    ref_lengths = lengths[num_candidates:]
+    # Closest reference length, ties broken towards the shorter reference
+    distance = np.abs(ref_lengths - hyp_lengths[owners]) * (ref_lengths.max() + 1) + ref_lengths
+    closest = np.full(num_candidates, np.iinfo(np.int64).max)
+    np.minimum.at(closest, owners, distance)
+    closest_lengths = closest % (ref_lengths.max() + 1)
+    return numerators, denominators, hyp_lengths, closest_lengths
+
+
+def _bleu(numerators, denominators, hyp_lengths, ref_lengths):
+    # Cumulative BLEU-1..N with uniform weights, exactly as nltk's unsmoothed corpus_bleu
+    hyp_lengths = np.asarray(hyp_lengths, dtype=np.float64)
+    ref_lengths = np.asarray(ref_lengths, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_precision = np.where(numerators > 0, np.log(numerators / denominators), _ZERO_PRECISION_LOG)
+        brevity = np.where(hyp_lengths > ref_lengths, 1.0,
+                           np.where(hyp_lengths == 0, 0.0, np.exp(1 - ref_lengths / hyp_lengths)))
+    orders = np.arange(1, numerators.shape[-1] + 1)
+    scores = brevity[..., None] * np.exp(np.cumsum(log_precision, axis=-1) / orders)
+    return np.where(numerators[..., :1] > 0, scores, 0.0)
+
+
+def bleu_scores(references, candidates, max_n=MAX_N):
+    """Corpus-level and sentence-level BLEU-1..max_n for tokenized candidates.
+
+    references[i] is the list of tokenized references for candidates[i]. Returns
+    (corpus scores of shape [max_n], sentence scores of shape [len(candidates), max_n]).
+    """
+    numerators, denominators, hyp_lengths, ref_lengths = ngram_counts(candidates, references, max_n)
+    sentence = _bleu(numerators, denominators, hyp_lengths, ref_lengths)
+    corpus = _bleu(numerators.sum(axis=0), denominators.sum(axis=0), hyp_lengths.sum(), ref_lengths.sum())
+    return corpus, sentence
+
+
+class _Lemma:
+    __slots__ = ("_name",)
+
+    def __init__(self, name):
+        self._name = name
+
+    def name(self):
+        return self._name
+
+
+class _Synset:
+    __slots__ = ("_lemmas",)
+
+    def __init__(self, names):
+        self._lemmas = [_Lemma(name) for name in names]
+
+    def lemmas(self):
+        return self._lemmas
+
+
+class MemoWordNet:
+    """The slice of the WordNet reader METEOR uses, with each word's synsets looked up once."""
+
+    def __init__(self, wordnet=None):
+        if wordnet is None:
+            from nltk.corpus import wordnet
+        self._wordnet = wordnet
+        self._synsets = {}
+
+    def synsets(self, word):
+        synsets = self._synsets.get(word)
+        if synsets is None:
+            synsets = [_Synset([lemma.name() for lemma in s.lemmas()]) for s in self._wordnet.synsets(word)]
+            self._synsets[word] = synsets
+        return synsets
+
+
+class MemoStemmer:
+    def __init__(self, stemmer=None):
+        if stemmer is None:
+            from nltk.stem.porter import PorterStemmer
+            stemmer = PorterStemmer()
+        self._stemmer = stemmer
+        self._stems = {}
+
+    def stem(self, word):
+        stem = self._stems.get(word)
+        if stem is None:
+            stem = self._stems[word] = self._stemmer.stem(word)
+        return stem
+
+
+_worker_state = {}
+
+
+def _init_meteor_worker(wordnet=None):
+    _worker_state["wordnet"] = MemoWordNet(wordnet)
+    _worker_state["stemmer"] = MemoStemmer()
+
+
+def _meteor_chunk(pairs):
+    from nltk.translate.meteor_score import meteor_score
+    if not _worker_state:
+        _init_meteor_worker()
+    wordnet, stemmer = _worker_state["wordnet"], _worker_state["stemmer"]
+    return [meteor_score(refs, candidate, stemmer=stemmer, wordnet=wordnet) for refs, candidate in pairs]
+
+
+def meteor_scores(references, candidates, workers=None, chunksize=256, wordnet=None):
+    """nltk METEOR for every candidate, spread over a process pool with memoized WordNet lookups.
+
+    workers=0 scores in this process; None uses one worker per CPU.
+    """
+    pairs = list(zip(references, candidates))
+    chunks = [pairs[i:i + chunksize] for i in range(0, len(pairs), chunksize)]
+    if workers == 0 or len(chunks) <= 1:
+        _init_meteor_worker(wordnet)
+        return [score for chunk in chunks for score in _meteor_chunk(chunk)]
+    # Spawned, not forked: callers have usually started torch's thread pools and loaded a model by now
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_meteor_worker, initargs=(wordnet,)) as pool:
+        return [score for chunk_scores in pool.map(_meteor_chunk, chunks) for score in chunk_scores]
+
+
+def evaluate(references, candidates, workers=None):
+    """BLEU-1..4 (corpus and per sentence) and per-sentence METEOR for tokenized candidates."""
+    corpus_bleu, sentence_bleu = bleu_scores(references, candidates)
+    return {
+        "corpus_bleu": corpus_bleu,
+        "sentence_bleu": sentence_bleu,
+        "meteor": meteor_scores(references, candidates, workers),
+    }
+
+
+def stored_scores(store, image_paths, model_id, generate_kwargs, references, candidates, names=("bleu", "meteor"),
+                  instrumentation=None, workers=0):
+    """Sentence BLEU-4 and METEOR per candidate, reusing the scores a ResultStore already holds.
+
+    Only candidates whose stored record lacks a score are scored, in one batch, and the new scores
+    are written back with store.add_scores under names. Scripts that tokenize differently should
+    use their own names, since the scores are not comparable. METEOR runs in this process by
+    default: the scripts have no __main__ guard, so spawned workers would re-run them. Returns
+    (bleu, meteor) lists.
+    """
+    from instrumentation import DISABLED
+
+    instrumentation = instrumentation or DISABLED
+    bleu_name, meteor_name = names
+    records = [store.get(path, model_id, generate_kwargs) for path in image_paths]
+    todo = [i for i, record in enumerate(records)
+            if bleu_name not in record["scores"] or meteor_name not in record["scores"]]
+    if todo:
+        refs = [references[i] for i in todo]
+        cands = [candidates[i] for i in todo]
+        with instrumentation.stage("bleu"):
+            bleu = bleu_scores(refs, cands)[1][:, 3]
+        with instrumentation.stage("meteor"):
+            meteor = meteor_scores(refs, cands, workers)
+        for i, b, m in zip(todo, bleu, meteor):
+            records[i] = store.add_scores(image_paths[i], model_id, generate_kwargs,
+                                          {bleu_name: float(b), meteor_name: float(m)})
+    return [record["scores"][bleu_name] for record in records], [record["scores"][meteor_name] for record in records]
+
+
+def _benchmark(references, candidates, workers, with_meteor):
+    import warnings
+    from nltk.translate.bleu_score import sentence_bleu, corpus_bleu
+    from nltk.translate.meteor_score import meteor_score
+
+    warnings.filterwarnings("ignore", module="nltk")
+    results = {}
+    start = time.perf_counter()
+    loop_bleu = [sentence_bleu(refs, cand) for refs, cand in zip(references, candidates)]
+    loop_corpus = corpus_bleu(references, candidates)
+    results["nltk bleu loop"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    corpus, sentence = bleu_scores(references, candidates)
+    results["batched bleu"] = time.perf_counter() - start
+    bleu_diff = max(np.max(np.abs(sentence[:, 3] - loop_bleu)), abs(corpus[3] - loop_corpus))
+
+    meteor_diff = None
+    if with_meteor:
+        start = time.perf_counter()
+        loop_meteor = [meteor_score(refs, cand) for refs, cand in zip(references, candidates)]
+        results["nltk meteor loop"] = time.perf_counter() - start
+        start = time.perf_counter()
+        pooled = meteor_scores(references, candidates, workers)
+        results["pooled meteor"] = time.perf_counter() - start
+        meteor_diff = float(np.max(np.abs(np.array(pooled) - loop_meteor)))
+    return results, bleu_diff, meteor_diff
+
+
+if __name__ == "__main__":
+    from ground_truth import load_captions
+    from blip_loader import ensure_wordnet
+
+    parser = argparse.ArgumentParser(description="Benchmark the batched evaluator against the per-sentence nltk loop")
+    parser.add_argument("--captions", default="captions.txt")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    # Score each image's first reference against the remaining ones, across the whole dataset
+    index = load_captions(args.captions)
+    references, candidates = [], []
+    for image in index.images[:args.limit]:
+        refs = [[t.lower() for t in ref] for ref in index.references(image)]
+        if len(refs) > 1:
+            candidates.append(refs[0])
+            references.append(refs[1:])
+
+    results, bleu_diff, meteor_diff = _benchmark(references, candidates, args.workers, ensure_wordnet())
+    print(f"{len(candidates)} candidates")
+    for name, seconds in results.items():
+        print(f"{name}: {seconds:.3f}s")
+    print(f"max |BLEU - nltk|: {bleu_diff:.2e}")
+    if meteor_diff is not None:
+        print(f"max |METEOR - nltk|: {meteor_diff:.2e}")
@@ -0,0 +1,165 @@
+import os
+import time
+import argparse
+import tracemalloc
+import numpy as np
+from PIL import Image
+
+# How images are decoded before the model: "pil" is load_image + BlipProcessor, "draft" is FastPreprocessor
+DECODE_MODES = ("pil", "draft")
+
+
+def decode_mode(decode=None):
+    """The decode mode to use: the argument if given, else $CAPTION_DECODE, else the tuning profile's, else "pil"."""
+    from host_profile import tuned
+
+    decode = decode or os.environ.get("CAPTION_DECODE") or tuned("decode", "pil")
+    if decode not in DECODE_MODES:
+        raise ValueError(f"unknown decode mode {decode!r}; use one of {', '.join(DECODE_MODES)}")
+    return decode
+
+
+def decode_resized(image_path, size, resample=Image.Resampling.BICUBIC):
+    """Decode an image straight to (height, width) RGB.
+
+    JPEG draft mode lets libjpeg scale by 1/2, 1/4 or 1/8 while decoding; it only picks a scale that
+    keeps both sides at or above the target, so the final resize still only ever shrinks.
+    """
+    height, width = size
+    image = Image.open(image_path)
+    image.draft("RGB", (width, height))
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return image.resize((width, height), resample=resample)
+
+
+class FastPreprocessor:
+    """BlipProcessor's image preprocessing from file paths, without per-image float arrays or tensors.
+
+    decode() resizes each image into one uint8 (N, H, W, 3) buffer; normalize() turns the whole
+    buffer into channels-first float32 with image_dataset.normalize, the same code the memory-mapped
+    dataset reads through. Calling the object does both. Use fast_preprocessor() to share one per
+    processor.
+    """
+
+    def __init__(self, processor):
+        image_processor = processor.image_processor
+        self.processor = processor
+        self.size = (image_processor.size["height"], image_processor.size["width"])
+        self.resample = Image.Resampling(image_processor.resample)
+
+    def decode(self, image_paths, out=None):
+        height, width = self.size
+        if out is None:
+            out = np.empty((len(image_paths), height, width, 3), dtype=np.uint8)
+        for i, path in enumerate(image_paths):
+            out[i] = decode_resized(path, self.size, self.resample)
+        return out
+
+    def normalize(self, pixels, out=None):
+        from image_dataset import normalize
+        return normalize(pixels, self.processor, out)
+
+    def __call__(self, image_paths):
+        return self.normalize(self.decode(image_paths))
+
+
+_preprocessors = {}
+
+
+def fast_preprocessor(processor):
+    """The FastPreprocessor for processor, built on first use and reused by every later batch."""
+    entry = _preprocessors.get(id(processor))
+    if entry is None or entry[0] is not processor:
+        entry = _preprocessors[id(processor)] = (processor, FastPreprocessor(processor))
+    return entry[1]
+
+
+def _measure(fn, image_paths, batch_size):
+    # Wall time and tracemalloc peak per batch; numpy buffers are traced, torch's own allocator is not
+    seconds, peaks = 0.0, []
+    outputs = []
+    tracemalloc.start()
+    try:
+        for start in range(0, len(image_paths), batch_size):
+            batch = image_paths[start:start + batch_size]
+            tracemalloc.reset_peak()
+            before_bytes, _ = tracemalloc.get_traced_memory()
+            begin = time.perf_counter()
+            result = fn(batch)
+            seconds += time.perf_counter() - begin
+            peaks.append(tracemalloc.get_traced_memory()[1] - before_bytes)
+            outputs.append(result)
+    finally:
+        tracemalloc.stop()
+    return seconds, peaks, outputs
+
+
+def compare_decoders(image_paths, processor, batch_size=8, tolerance=2.0):
+    """Time and allocation figures for both decode paths, and how far the fast one drifts from BlipProcessor.
+
+    Drift is measured in 8-bit pixel levels; the check passes when the mean absolute difference
+    is within tolerance levels.
+    """
+    from image_pipeline import load_image
+
+    fast = FastPreprocessor(processor)
+
+    def pil_path(batch):
+        return processor([load_image(path) for path in batch], return_tensors="pt")["pixel_values"]
+
+    results = {}
+    for name, fn in (("pil", pil_path), ("draft", fast)):
+        fn(image_paths[:batch_size])
+        seconds, peaks, outputs = _measure(fn, image_paths, batch_size)
+        results[name] = {
+            "ms_per_image": seconds / len(image_paths) * 1000,
+            "peak_kib_per_image": float(np.mean(peaks)) / batch_size / 1024,
+            "outputs": outputs,
+        }
+
+    std = np.array(processor.image_processor.image_std, dtype=np.float32).reshape(1, 3, 1, 1)
+    diffs = np.concatenate([(np.abs(a.numpy() - b.numpy()) * std * 255).ravel()
+                            for a, b in zip(results["pil"].pop("outputs"), results["draft"].pop("outputs"))])
+    reduced = 0
+    for path in image_paths:
+        with Image.open(path) as image:
+            full = image.size
+            image.draft("RGB", fast.size[::-1])
+            reduced += image.size != full
+    return {
+        "images": len(image_paths),
+        "draft_reduced": reduced,
+        "paths": results,
+        "mean_abs_levels": float(diffs.mean()),
+        "p99_abs_levels": float(np.percentile(diffs, 99)),
+        "max_abs_levels": float(diffs.max()),
+        "within_tolerance": bool(diffs.mean() <= tolerance),
+    }
+
+
+def print_comparison(report):
+    print(f"{report['images']} images, {report['draft_reduced']} decoded at reduced scale by draft mode")
+    print(f"{'path':<6} {'ms/img':>8} {'peak KiB/img':>13}")
+    for name, row in report["paths"].items():
+        print(f"{name:<6} {row['ms_per_image']:>8.2f} {row['peak_kib_per_image']:>13.0f}")
+    print(f"difference from BlipProcessor (8-bit levels): mean {report['mean_abs_levels']:.3f}, "
+          f"p99 {report['p99_abs_levels']:.2f}, max {report['max_abs_levels']:.2f} -> "
+          f"{'OK' if report['within_tolerance'] else 'OUT OF TOLERANCE'}")
+
+
+if __name__ == "__main__":
+    from blip_loader import get_processor, MODEL_ID
+    from image_pipeline import iter_image_paths
+
+    parser = argparse.ArgumentParser(description="Compare the draft-mode decode fast path against BlipProcessor")
+    parser.add_argument("--images", default="images")
+    parser.add_argument("--limit", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--tolerance", type=float, default=2.0, help="allowed mean difference in 8-bit levels")
+    parser.add_argument("--model", default=MODEL_ID, help="model id or local directory whose processor to match")
+    args = parser.parse_args()
+
+    report = compare_decoders(list(iter_image_paths(args.images, args.limit)), get_processor(args.model),
+                              args.batch_size, args.tolerance)
+    print_comparison(report)
@@ -0,0 +1,162 @@
+import os
+import csv
+import sys
+import time
+import numpy as np
+
+DEFAULT_CAPTIONS_FILE = "captions.txt"
+SIDECAR_SUFFIX = ".idx.npz"
+INDEX_VERSION = 1
+
+
+class CaptionIndex:
+    """Every reference caption per image, stored as interned token ids in flat arrays.
+
+    token_ids holds all tokens back to back; caption_offsets[c]:caption_offsets[c + 1] slices
+    caption c, and image_offsets[i]:image_offsets[i + 1] gives the captions of image i.
+    """
+
+    def __init__(self, images, vocab, token_ids, caption_offsets, image_offsets):
+        self.images = images
+        self.vocab = vocab
+        self.token_ids = token_ids
+        self.caption_offsets = caption_offsets
+        self.image_offsets = image_offsets
+        self._image_index = {name: i for i, name in enumerate(images)}
+
+    def __len__(self):
+        return len(self.images)
+
+    def __contains__(self, image):
+        return image in self._image_index
+
+    def caption_range(self, image):
+        """(start, end) caption numbers of image's references, or None if image is unknown."""
+        i = self._image_index.get(image)
+        if i is None:
+            return None
+        return int(self.image_offsets[i]), int(self.image_offsets[i + 1])
+
+    def reference_ids(self, image):
+        """Token-id arrays of every reference caption for image (empty list if unknown)."""
+        caption_range = self.caption_range(image)
+        if caption_range is None:
+            return []
+        start, end = caption_range
+        offsets = self.caption_offsets[start:end + 1]
+        return [self.token_ids[offsets[c]:offsets[c + 1]] for c in range(end - start)]
+
+    def references(self, image):
+        """Every reference caption for image as a list of tokens."""
+        vocab = self.vocab
+        return [[vocab[t] for t in ids] for ids in self.reference_ids(image)]
+
+    def captions(self, image):
+        """Every reference caption for image as a string."""
+        return [" ".join(tokens) for tokens in self.references(image)]
+
+
+def parse_captions(path=DEFAULT_CAPTIONS_FILE):
+    """Build a CaptionIndex straight from the image,caption CSV."""
+    by_image = {}
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            if len(row) >= 2:
+                by_image.setdefault(row[0], []).append(",".join(row[1:]))
+
+    vocab, token_index = [], {}
+    token_ids, caption_offsets, image_offsets = [], [0], [0]
+    for captions in by_image.values():
+        for caption in captions:
+            for token in caption.split():
+                token_id = token_index.get(token)
+                if token_id is None:
+                    token_id = token_index[token] = len(vocab)
+                    vocab.append(token)
+                token_ids.append(token_id)
+            caption_offsets.append(len(token_ids))
+        image_offsets.append(len(caption_offsets) - 1)
+
+    return CaptionIndex(
+        list(by_image),
+        vocab,
+        np.array(token_ids, dtype=np.int32),
+        np.array(caption_offsets, dtype=np.int64),
+        np.array(image_offsets, dtype=np.int64),
+    )
+
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return np.array([INDEX_VERSION, stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
+
+def save_index(index, sidecar_path, stamp):
+    tmp_path = f"{sidecar_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            stamp=stamp,
+            images=np.frombuffer("\n".join(index.images).encode(), dtype=np.uint8),
+            vocab=np.frombuffer("\n".join(index.vocab).encode(), dtype=np.uint8),
+            token_ids=index.token_ids,
+            caption_offsets=index.caption_offsets,
+            image_offsets=index.image_offsets,
+        )
+    os.replace(tmp_path, sidecar_path)
+
+
+def _load_sidecar(sidecar_path, stamp):
+    try:
+        with np.load(sidecar_path) as data:
+            if not np.array_equal(data["stamp"], stamp):
+                return None
+            return CaptionIndex(
+                data["images"].tobytes().decode().split("\n"),
+                data["vocab"].tobytes().decode().split("\n"),
+                data["token_ids"],
+                data["caption_offsets"],
+                data["image_offsets"],
+            )
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+_loaded = {}
+
+
+def load_captions(path=DEFAULT_CAPTIONS_FILE):
+    """The CaptionIndex for path, read from its binary sidecar unless the CSV changed since it was built."""
+    stamp = _source_stamp(path)
+    key = os.path.abspath(path)
+    cached = _loaded.get(key)
+    if cached is not None and np.array_equal(cached[0], stamp):
+        return cached[1]
+
+    sidecar_path = path + SIDECAR_SUFFIX
+    index = _load_sidecar(sidecar_path, stamp)
+    if index is None:
+        index = parse_captions(path)
+        save_index(index, sidecar_path, stamp)
+    _loaded[key] = (stamp, index)
+    return index
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_CAPTIONS_FILE
+
+    start = time.perf_counter()
+    index = parse_captions(path)
+    parse_seconds = time.perf_counter() - start
+    save_index(index, path + SIDECAR_SUFFIX, _source_stamp(path))
+
+    start = time.perf_counter()
+    index = _load_sidecar(path + SIDECAR_SUFFIX, _source_stamp(path))
+    load_seconds = time.perf_counter() - start
+
+    print(f"{len(index)} images, {len(index.caption_offsets) - 1} captions, "
+          f"{len(index.token_ids)} tokens, {len(index.vocab)} distinct tokens")
+    print(f"Parse CSV: {parse_seconds * 1000:.1f} ms")
+    print(f"Load sidecar: {load_seconds * 1000:.1f} ms")
@@ -0,0 +1,75 @@
+import os
+import sys
+import json
+import platform
+
+DEFAULT_PROFILE_DIR = os.path.join(".cache", "tuning")
+
+_profile = None
+_loaded = False
+_threads_applied = False
+
+
+def profile_path(host=None):
+    return os.path.join(DEFAULT_PROFILE_DIR, f"{host or platform.node() or 'localhost'}.json")
+
+
+def load_profile():
+    """This host's tuning profile written by autotune.py, or None.
+
+    $CAPTION_TUNING can point at another profile file, or be "off" to ignore profiles entirely.
+    """
+    global _profile, _loaded
+    if not _loaded:
+        _loaded = True
+        path = os.environ.get("CAPTION_TUNING") or profile_path()
+        if path != "off" and os.path.exists(path):
+            with open(path) as f:
+                _profile = json.load(f)
+    return _profile
+
+
+def save_profile(profile, path=None):
+    path = path or profile_path()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(profile, f, indent=2)
+    os.replace(tmp_path, path)
+    return path
+
+
+def tuned(name, default):
+    """A setting from this host's profile, or default when there is no profile or it lacks the setting."""
+    profile = load_profile()
+    if profile is None:
+        return default
+    return profile["config"].get(name, default)
+
+
+def apply_threads():
+    """Set torch's intra-op and inter-op thread counts from the profile, once per process.
+
+    OMP_NUM_THREADS in the environment wins over the profile, and inter-op threads are left
+    alone if torch has already fixed them (they can only be set before any parallel work).
+    """
+    global _threads_applied
+    if _threads_applied:
+        return
+    _threads_applied = True
+    profile = load_profile()
+    if profile is None:
+        return
+    import torch
+
+    config = profile["config"]
+    if "threads" in config and not os.environ.get("OMP_NUM_THREADS"):
+        torch.set_num_threads(config["threads"])
+    if "interop_threads" in config:
+        try:
+            torch.set_num_interop_threads(config["interop_threads"])
+        except RuntimeError:
+            pass
+    if profile.get("cpus") not in (None, os.cpu_count()):
+        print(f"Tuning profile was made on {profile['cpus']} CPUs; this host has {os.cpu_count()}. "
+              f"Re-run autotune.py.", file=sys.stderr)
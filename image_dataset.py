@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+from image_pipeline import batched, load_image, iter_image_paths
+from embedding_cache import file_hash
+
+DEFAULT_DATASET_DIR = os.path.join(".cache", "pixels")
+INDEX_FILE = "index.json"
+PIXELS_FILE = "pixels.u8"
+
+
+def _processor_size(processor):
+    image_processor = processor.image_processor
+    return image_processor.size["height"], image_processor.size["width"], int(image_processor.resample)
+
+
+def normalize(pixels, processor, out=None):
+    """(N, H, W, 3) uint8 RGB to the (N, 3, H, W) float pixel_values BlipProcessor would produce.
+
+    The returned tensor shares out, a float32 (N, 3, H, W) array allocated when not given.
+    """
+    image_processor = processor.image_processor
+    mean = np.array(image_processor.image_mean, dtype=np.float32).reshape(1, 3, 1, 1)
+    std = np.array(image_processor.image_std, dtype=np.float32).reshape(1, 3, 1, 1)
+    if out is None:
+        out = np.empty((pixels.shape[0], 3) + pixels.shape[1:3], dtype=np.float32)
+    # (x * rescale - mean) / std folded into one scale and one shift per channel: a single multiply
+    # converts to float and reorders to channels-first, then the shift is subtracted in place
+    np.multiply(pixels.transpose(0, 3, 1, 2), np.float32(image_processor.rescale_factor) / std, out=out,
+                casting="unsafe")
+    out -= mean / std
+    return torch.from_numpy(out)
+
+
+class ImageDataset:
+    """A folder of images pre-resized to the processor's input size, as one memory-mapped uint8 array.
+
+    pixels.u8 holds one (height, width, 3) RGB row per image; index.json maps each file name to
+    its row, its content hash and the (size, mtime) it had when converted. Normalisation happens
+    at read time, so conversion only pays for decoding and resizing. update() appends new images
+    and rewrites the rows of images whose contents changed.
+    """
+
+    def __init__(self, path=DEFAULT_DATASET_DIR, height=384, width=384, resample=int(Image.Resampling.BICUBIC)):
+        self.path = path
+        self.index = {"height": height, "width": width, "resample": resample, "rows": 0, "images": {}}
+        index_path = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+        self.shape = (self.index["height"], self.index["width"], 3)
+        self.row_bytes = int(np.prod(self.shape))
+        self._pixels = None
+
+    def __len__(self):
+        return len(self.index["images"])
+
+    def _file_id(self, image_path):
+        stat = os.stat(image_path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def _convert(self, image_path):
+        height, width, _ = self.shape
+        image = load_image(image_path).resize((width, height), resample=Image.Resampling(self.index["resample"]))
+        return np.asarray(image, dtype=np.uint8).tobytes()
+
+    def update(self, image_paths, workers=2):
+        """Convert images that are new or whose bytes changed; returns counts of added/changed/unchanged."""
+        counts = {"added": 0, "changed": 0, "unchanged": 0}
+        images = self.index["images"]
+        todo = []
+        for path in image_paths:
+            name = os.path.basename(path)
+            entry = images.get(name)
+            file_id = self._file_id(path)
+            if entry is not None and entry["file"] == file_id:
+                counts["unchanged"] += 1
+                continue
+            image_hash = file_hash(path)
+            if entry is not None and entry["hash"] == image_hash:
+                # Touched but not modified
+                entry["file"] = file_id
+                counts["unchanged"] += 1
+                continue
+            todo.append((path, name, image_hash, file_id, entry))
+
+        os.makedirs(self.path, exist_ok=True)
+        pixels_path = os.path.join(self.path, PIXELS_FILE)
+        with open(pixels_path, "r+b" if os.path.exists(pixels_path) else "w+b") as f:
+            # Rows written after the index was last saved belong to an interrupted update
+            f.truncate(self.index["rows"] * self.row_bytes)
+            with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+                for batch in batched(todo, 64):
+                    for (path, name, image_hash, file_id, entry), data in zip(
+                            batch, pool.map(self._convert, [item[0] for item in batch])):
+                        if entry is None:
+                            row = self.index["rows"]
+                            self.index["rows"] += 1
+                            counts["added"] += 1
+                        else:
+                            row = entry["row"]
+                            counts["changed"] += 1
+                        f.seek(row * self.row_bytes)
+                        f.write(data)
+                        images[name] = {"row": row, "hash": image_hash, "file": file_id}
+        self._save_index()
+        self._pixels = None
+        return counts
+
+    def _save_index(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, index_path)
+
+    def pixels(self):
+        """The whole (rows, H, W, 3) array, memory-mapped copy-on-write so slices are writable views."""
+        if self._pixels is None and self.index["rows"]:
+            self._pixels = np.memmap(os.path.join(self.path, PIXELS_FILE), dtype=np.uint8, mode="c",
+                                     shape=(self.index["rows"],) + self.shape)
+        return self._pixels
+
+    def row(self, image_path):
+        """The row holding image_path, or None if it was never converted or has changed since."""
+        entry = self.index["images"].get(os.path.basename(image_path))
+        if entry is None or entry["file"] != self._file_id(image_path):
+            return None
+        return entry["row"]
+
+    def read(self, rows):
+        """uint8 pixels for rows; a run of consecutive rows is a zero-copy view of the mapping."""
+        pixels = self.pixels()
+        if all(b == a + 1 for a, b in zip(rows, rows[1:])):
+            return pixels[rows[0]:rows[-1] + 1]
+        return pixels[rows]
+
+    def pixel_values(self, image_paths, processor):
+        """Normalised pixel_values for a batch; images missing from the dataset are decoded as usual."""
+        if _processor_size(processor) != (self.index["height"], self.index["width"], self.index["resample"]):
+            raise ValueError(f"{self.path} was converted for a different processor resolution")
+        rows = [self.row(path) for path in image_paths]
+        missing = [i for i, row in enumerate(rows) if row is None]
+        if not missing:
+            return normalize(self.read(rows), processor)
+        pixels = np.empty((len(image_paths),) + self.shape, dtype=np.uint8)
+        stored = [i for i, row in enumerate(rows) if row is not None]
+        if stored:
+            pixels[stored] = self.read([rows[i] for i in stored])
+        for i in missing:
+            pixels[i] = np.frombuffer(self._convert(image_paths[i]), dtype=np.uint8).reshape(self.shape)
+        return normalize(pixels, processor)
+
+
+def open_dataset(path=DEFAULT_DATASET_DIR):
+    """The converted dataset at path, or None if image_dataset.py has not been run."""
+    if not os.path.exists(os.path.join(path, INDEX_FILE)):
+        return None
+    return ImageDataset(path)
+
+
+def convert_folder(image_folder, processor, path=DEFAULT_DATASET_DIR, workers=2, limit=None):
+    height, width, resample = _processor_size(processor)
+    dataset = ImageDataset(path, height, width, resample)
+    if (dataset.index["height"], dataset.index["width"], dataset.index["resample"]) != (height, width, resample):
+        raise ValueError(f"{path} was converted for a different processor resolution; delete it to rebuild")
+    return dataset, dataset.update(iter_image_paths(image_folder, limit), workers)
+
+
+if __name__ == "__main__":
+    from blip_loader import get_processor, MODEL_ID
+
+    parser = argparse.ArgumentParser(description="Convert an image folder to a memory-mapped uint8 dataset")
+    parser.add_argument("--images", default="images")
+    parser.add_argument("--output", default=DEFAULT_DATASET_DIR)
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--model", default=MODEL_ID, help="model id or local directory whose processor to match")
+    args = parser.parse_args()
+
+    processor = get_processor(args.model)
+    start = time.perf_counter()
+    dataset, counts = convert_folder(args.images, processor, args.output, args.workers, args.limit)
+    size = os.path.getsize(os.path.join(args.output, PIXELS_FILE))
+    print(f"{len(dataset)} images in {args.output} ({size / 1024 ** 2:.0f} MiB): {counts['added']} added, "
+          f"{counts['changed']} changed, {counts['unchanged']} unchanged in {time.perf_counter() - start:.1f}s")
+
+    # Compare one batch against decoding and preprocessing from the JPEGs
+    batch_paths = list(iter_image_paths(args.images, args.batch_size))
+    start = time.perf_counter()
+    expected = processor([load_image(path) for path in batch_paths], return_tensors="pt")["pixel_values"]
+    decode_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    pixel_values = dataset.pixel_values(batch_paths, processor)
+    read_seconds = time.perf_counter() - start
+    print(f"batch of {len(batch_paths)}: decode+processor {decode_seconds * 1000:.1f} ms, dataset "
+          f"{read_seconds * 1000:.1f} ms, max abs difference {(pixel_values - expected).abs().max().item():.2e}")
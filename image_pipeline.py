@@ -0,0 +1,163 @@
+import os
+import argparse
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def batched(items, batch_size):
+    # Works for lists and one-shot iterators alike
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load_image(image_path):
+    return Image.open(image_path).convert("RGB")
+
+
+def iter_image_paths(image_folder, limit=None):
+    """Stream image paths from a folder in name order without building a stat list first."""
+    names = sorted(entry.name for entry in os.scandir(image_folder)
+                   if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS))
+    for name in names[:limit]:
+        yield os.path.join(image_folder, name)
+
+
+class PrefetchPipeline:
+    """Decode and preprocess batches on a worker pool while the caller runs the model.
+
+    At most queue_depth preprocessed batches wait in memory; when the queue is full the feeder
+    blocks (backpressure) until the model takes the next one. Iterating yields
+    (batch_paths, pixel_values) in input order. decode="draft" uses fast_decode.FastPreprocessor
+    instead of load_image and the processor.
+    """
+
+    def __init__(self, image_paths, processor, batch_size=8, workers=2, queue_depth=2, decode="pil"):
+        self.image_paths = image_paths
+        self.processor = processor
+        self.fast = None
+        if decode == "draft":
+            from fast_decode import fast_preprocessor
+            self.fast = fast_preprocessor(processor)
+        self.batch_size = batch_size
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.stats = {"batches": 0, "images": 0, "decode_seconds": 0.0, "preprocess_seconds": 0.0,
+                      "backpressure_seconds": 0.0, "starved_seconds": 0.0, "compute_seconds": 0.0,
+                      "wall_seconds": 0.0, "max_queued": 0}
+        self._lock = threading.Lock()
+
+    def _prepare(self, batch_paths):
+        start = time.perf_counter()
+        if self.fast is not None:
+            pixels = self.fast.decode(batch_paths)
+            decoded = time.perf_counter()
+            pixel_values = self.fast.normalize(pixels)
+        else:
+            images = [load_image(path) for path in batch_paths]
+            decoded = time.perf_counter()
+            pixel_values = self.processor(images, return_tensors="pt")["pixel_values"]
+        done = time.perf_counter()
+        with self._lock:
+            self.stats["decode_seconds"] += decoded - start
+            self.stats["preprocess_seconds"] += done - decoded
+        return pixel_values
+
+    def _feed(self, pool, pending, stop):
+        try:
+            for batch_paths in batched(self.image_paths, self.batch_size):
+                future = pool.submit(self._prepare, batch_paths)
+                start = time.perf_counter()
+                while not stop.is_set():
+                    try:
+                        pending.put((batch_paths, future), timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                self.stats["backpressure_seconds"] += time.perf_counter() - start
+                self.stats["max_queued"] = max(self.stats["max_queued"], pending.qsize())
+                if stop.is_set():
+                    return
+        finally:
+            pending.put(None)
+
+    def __iter__(self):
+        pending = queue.Queue(maxsize=self.queue_depth)
+        stop = threading.Event()
+        wall_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            feeder = threading.Thread(target=self._feed, args=(pool, pending, stop), daemon=True)
+            feeder.start()
+            try:
+                while True:
+                    start = time.perf_counter()
+                    item = pending.get()
+                    if item is None:
+                        break
+                    batch_paths, future = item
+                    pixel_values = future.result()
+                    self.stats["starved_seconds"] += time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    yield batch_paths, pixel_values
+                    self.stats["compute_seconds"] += time.perf_counter() - start
+                    self.stats["batches"] += 1
+                    self.stats["images"] += len(batch_paths)
+            finally:
+                stop.set()
+                # Drain so the feeder can reach its end-of-stream marker
+                while feeder.is_alive():
+                    try:
+                        pending.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                self.stats["wall_seconds"] = time.perf_counter() - wall_start
+
+    def utilisation(self):
+        """Busy fraction of each stage over the run; the stage closest to 1.0 is the bottleneck."""
+        wall = self.stats["wall_seconds"] or 1e-9
+        worker_busy = self.stats["decode_seconds"] + self.stats["preprocess_seconds"]
+        return {
+            "decode_workers": worker_busy / (self.workers * wall),
+            "inference": self.stats["compute_seconds"] / wall,
+            "inference_starved": self.stats["starved_seconds"] / wall,
+            "feeder_blocked": self.stats["backpressure_seconds"] / wall,
+        }
+
+    def print_report(self):
+        print(f"\nPipeline: {self.stats['images']} images in {self.stats['batches']} batches, "
+              f"{self.stats['wall_seconds']:.2f}s, queue depth {self.queue_depth} (max used {self.stats['max_queued']})")
+        for stage, fraction in self.utilisation().items():
+            print(f"{stage}: {fraction:.1%}")
+
+
+if __name__ == "__main__":
+    from blip_loader import get_processor, get_model
+    from caption_engine import caption_pipeline, GREEDY, BEAM_SEARCH
+
+    parser = argparse.ArgumentParser(description="Caption a folder through the prefetch pipeline and report stage utilisation")
+    parser.add_argument("--images", default="images")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--queue-depth", type=int, default=2)
+    parser.add_argument("--beam", action="store_true", help="use num_beams=5 instead of greedy decoding")
+    parser.add_argument("--decode", choices=("pil", "draft"), default="pil", help="JPEG decode path")
+    args = parser.parse_args()
+
+    processor = get_processor()
+    model = get_model()
+    pipeline = PrefetchPipeline(iter_image_paths(args.images, args.limit), processor,
+                                args.batch_size, args.workers, args.queue_depth, args.decode)
+    caption_pipeline(pipeline, processor, model, **(BEAM_SEARCH if args.beam else GREEDY))
+    pipeline.print_report()
@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import time
+import argparse
+import functools
+import contextlib
+import numpy as np
+
+# Stages of the caption-and-score hot path, in pipeline order
+STAGES = ("pil_decode", "processor", "vision_encoder", "generate", "text_decode", "bleu", "meteor")
+
+
+class _Stage:
+    __slots__ = ("instrumentation", "name", "items", "start")
+
+    def __init__(self, instrumentation, name, items):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.instrumentation.record(self.name, time.perf_counter() - self.start, self.items)
+        return False
+
+
+class Instrumentation:
+    """Per-stage wall-clock timers for the caption-and-score path, written as JSON lines.
+
+    Time spent in a stage is split evenly over the images being processed (the current batch, or
+    the items passed explicitly), giving per-image breakdowns as well as totals. close() writes
+    one {"image": ...} line per image followed by a {"summary": ...} line.
+
+    profile="torch" or "cprofile" records a torch.profiler Chrome trace or a cProfile dump while
+    the batches covering images [profile_start, profile_stop) run.
+    """
+
+    enabled = True
+
+    def __init__(self, output=None, profile=None, profile_start=0, profile_stop=8, profile_path=None):
+        if profile not in (None, "torch", "cprofile"):
+            raise ValueError(f"unknown profiler {profile!r}; use 'torch' or 'cprofile'")
+        self.output = output
+        self.profile = profile
+        self.profile_start = profile_start
+        self.profile_stop = profile_stop
+        self.profile_path = profile_path or ("trace.json" if profile == "torch" else "profile.prof")
+        self.images_seen = 0
+        self.per_image = {}
+        self.totals = {}
+        self._items = ()
+        self._profiler = None
+        self._profiled = False
+
+    def begin_batch(self, items):
+        """Mark the start of a batch of images; drives the profiling window."""
+        self._items = tuple(items)
+        first, self.images_seen = self.images_seen, self.images_seen + len(self._items)
+        if self.profile and not self._profiled:
+            if self._profiler is None and self.images_seen > self.profile_start:
+                self._start_profiler()
+            elif self._profiler is not None and first >= self.profile_stop:
+                self._stop_profiler()
+
+    def set_items(self, items):
+        """Attribute the following stages to these images, without counting a new batch."""
+        self._items = tuple(items)
+
+    def stage(self, name, items=None):
+        return _Stage(self, name, self._items if items is None else tuple(items))
+
+    def timed(self, name, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def record(self, name, seconds, items=()):
+        total = self.totals.setdefault(name, [0, 0, 0.0])
+        total[0] += 1
+        total[1] += len(items)
+        total[2] += seconds
+        if items:
+            share = seconds / len(items)
+            for item in items:
+                stages = self.per_image.setdefault(item, {})
+                stages[name] = stages.get(name, 0.0) + share
+
+    def summary(self):
+        stages = {}
+        for name in sorted(self.totals, key=lambda s: STAGES.index(s) if s in STAGES else len(STAGES)):
+            calls, items, seconds = self.totals[name]
+            per_image = np.array([image_stages[name] for image_stages in self.per_image.values()
+                                  if name in image_stages]) * 1000
+            stages[name] = {
+                "calls": calls,
+                "images": items,
+                "seconds": round(seconds, 6),
+                "p50_ms": round(float(np.percentile(per_image, 50)), 3) if len(per_image) else None,
+                "p95_ms": round(float(np.percentile(per_image, 95)), 3) if len(per_image) else None,
+            }
+        total = sum(stage["seconds"] for stage in stages.values()) or 1e-9
+        for stage in stages.values():
+            stage["share"] = round(stage["seconds"] / total, 4)
+        return {"images": len(self.per_image), "stages": stages}
+
+    def _start_profiler(self):
+        if self.profile == "torch":
+            import torch.profiler
+            self._profiler = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU])
+            self._profiler.start()
+        else:
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def _stop_profiler(self):
+        if self.profile == "torch":
+            self._profiler.stop()
+            self._profiler.export_chrome_trace(self.profile_path)
+        else:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile_path)
+        print(f"Wrote {self.profile} profile of images {self.profile_start}-{self.profile_stop} to "
+              f"{self.profile_path}", file=sys.stderr)
+        self._profiler = None
+        self._profiled = True
+
+    def close(self):
+        if self._profiler is not None:
+            self._stop_profiler()
+        if self.output is None:
+            return
+        with (contextlib.nullcontext(sys.stdout) if self.output == "-" else open(self.output, "w")) as f:
+            for image, stages in self.per_image.items():
+                record = {"image": image, "stages_ms": {k: round(v * 1000, 3) for k, v in stages.items()},
+                          "total_ms": round(sum(stages.values()) * 1000, 3)}
+                f.write(json.dumps(record) + "\n")
+            f.write(json.dumps({"summary": self.summary()}) + "\n")
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"\nStage breakdown over {summary['images']} images:")
+        print(f"{'stage':<15} {'seconds':>9} {'share':>7} {'p50 ms':>9} {'p95 ms':>9}")
+        for name, stage in summary["stages"].items():
+            p50 = f"{stage['p50_ms']:.2f}" if stage["p50_ms"] is not None else "-"
+            p95 = f"{stage['p95_ms']:.2f}" if stage["p95_ms"] is not None else "-"
+            print(f"{name:<15} {stage['seconds']:>9.3f} {stage['share']:>7.1%} {p50:>9} {p95:>9}")
+
+
+class _Disabled:
+    """Stand-in used when instrumentation is off: every hook is a no-op."""
+
+    enabled = False
+    _context = contextlib.nullcontext()
+
+    def begin_batch(self, items):
+        pass
+
+    def set_items(self, items):
+        pass
+
+    def stage(self, name, items=None):
+        return self._context
+
+    def timed(self, name, fn):
+        return fn
+
+    def record(self, name, seconds, items=()):
+        pass
+
+    def close(self):
+        pass
+
+    def print_summary(self):
+        pass
+
+
+DISABLED = _Disabled()
+
+
+def instrumentation_from_env():
+    """Instrumentation configured by environment variables, or DISABLED when none are set.
+
+    CAPTION_TRACE=path.jsonl (or "-" for stdout) turns on stage timing; CAPTION_PROFILE=torch|cprofile
+    adds a profiler over the images in CAPTION_PROFILE_IMAGES=start:stop (default 0:8).
+    """
+    output = os.environ.get("CAPTION_TRACE")
+    profile = os.environ.get("CAPTION_PROFILE")
+    if not output and not profile:
+        return DISABLED
+    start, stop = (int(x) for x in os.environ.get("CAPTION_PROFILE_IMAGES", "0:8").split(":"))
+    return Instrumentation(output or None, profile or None, start, stop)
+
+
+if __name__ == "__main__":
+    from nltk.translate.bleu_score import sentence_bleu
+    from nltk.translate.meteor_score import meteor_score
+    from blip_loader import get_processor, get_model, ensure_wordnet, MODEL_ID
+    from caption_engine import generate_captions, GREEDY, BEAM_SEARCH
+    from ground_truth import load_captions
+    from image_pipeline import iter_image_paths
+
+    parser = argparse.ArgumentParser(description="Caption and score a folder with per-stage timings")
+    parser.add_argument("--images", default="images")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--output", default="-", help="JSON lines destination ('-' for stdout)")
+    parser.add_argument("--profile", choices=("torch", "cprofile"), default=None)
+    parser.add_argument("--profile-images", default="0:8", help="start:stop image window to profile")
+    parser.add_argument("--profile-path", default=None)
+    parser.add_argument("--model", default=None, help="model id or local directory (default: BLIP base)")
+    parser.add_argument("--beam", action="store_true", help="use num_beams=5 instead of greedy decoding")
+    args = parser.parse_args()
+
+    start, stop = (int(x) for x in args.profile_images.split(":"))
+    instrumentation = Instrumentation(args.output, args.profile, start, stop, args.profile_path)
+    processor = get_processor(args.model or MODEL_ID)
+    model = get_model(args.model or MODEL_ID)
+    has_wordnet = ensure_wordnet()
+    ground_truth = load_captions("captions.txt")
+
+    image_paths = list(iter_image_paths(args.images, args.limit))
+    captions = generate_captions(image_paths, processor, model, batch_size=args.batch_size,
+                                 instrumentation=instrumentation, **(BEAM_SEARCH if args.beam else GREEDY))
+    sentence_bleu = instrumentation.timed("bleu", sentence_bleu)
+    meteor_score = instrumentation.timed("meteor", meteor_score)
+    for path, caption in zip(image_paths, captions):
+        name = os.path.basename(path)
+        reference = [c.split() for c in ground_truth.captions(name)]
+        if reference:
+            instrumentation.set_items([name])
+            sentence_bleu(reference, caption.split())
+            if has_wordnet:
+                meteor_score(reference, caption.split())
+    instrumentation.close()
+    instrumentation.print_summary()
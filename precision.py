@@ -0,0 +1,220 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import warnings
+import multiprocessing
+import numpy as np
+
+from ground_truth import load_captions, DEFAULT_CAPTIONS_FILE
+
+PRECISIONS = ("fp32", "int8", "bf16")
+DEFAULT_CACHE_DIR = os.path.join(".cache", "precision")
+
+
+def hub_revision(model_id):
+    """The commit of model_id's snapshot in the local Hugging Face cache; None for local directories or uncached ids."""
+    if os.path.isdir(model_id):
+        return None
+    from huggingface_hub import try_to_load_from_cache
+
+    # Resolves refs/main without touching the network: .../snapshots/<commit>/config.json
+    config_path = try_to_load_from_cache(model_id, "config.json")
+    if not isinstance(config_path, str):
+        return None
+    return os.path.basename(os.path.dirname(config_path))
+
+
+def artifact_path(model_id, variant, cache_dir):
+    """Where a converted form of model_id is cached; changes with the torch/transformers versions and the weights.
+
+    Hub ids are keyed by the cached snapshot's commit, so a new upstream revision is converted
+    afresh instead of loading stale weights; local directories by their config's mtime.
+    """
+    import torch
+    import transformers
+
+    # Quantized pickles and traces are only valid for the torch/transformers versions that wrote them
+    stamp = [model_id, variant, torch.__version__, transformers.__version__]
+    config_path = os.path.join(model_id, "config.json")
+    if os.path.exists(config_path):
+        stamp.append(str(os.stat(config_path).st_mtime_ns))
+    else:
+        stamp.append(hub_revision(model_id) or "unversioned")
+    digest = hashlib.sha256("\n".join(stamp).encode()).hexdigest()[:16]
+    name = model_id.strip("/").replace("/", "--")[-60:]
+    return os.path.join(cache_dir, f"{name}-{variant}-{digest}")
+
+
+def apply_precision(model, precision):
+    """Convert an fp32 BLIP: bf16 casts every weight, int8 swaps Linear layers for dynamically quantized ones."""
+    import torch
+
+    if precision == "int8":
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif precision == "bf16":
+        model = model.to(torch.bfloat16)
+    elif precision != "fp32":
+        raise ValueError(f"unknown precision {precision!r}; use one of {', '.join(PRECISIONS)}")
+    model.precision_mode = precision
+    return model.eval()
+
+
+def load_model(model_id, precision, load_fp32, cache_dir=DEFAULT_CACHE_DIR):
+    """BLIP in the given precision, converted from load_fp32() on first use and read from disk afterwards.
+
+    int8 models are pickled whole, since quantized modules cannot be rebuilt from a state dict
+    without quantizing again; bf16 models are saved as a bf16 safetensors checkpoint.
+    """
+    import torch
+    from transformers import BlipForConditionalGeneration
+
+    if precision == "fp32":
+        return apply_precision(load_fp32(), precision)
+    path = artifact_path(model_id, precision, cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    if precision == "int8":
+        if os.path.exists(path + ".pt"):
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                # Written by this function, not downloaded; needs full unpickling for quantized modules
+                model = torch.load(path + ".pt", weights_only=False)
+            model.precision_mode = precision
+            return model.eval()
+        model = apply_precision(load_fp32(), precision)
+        # A first download has only now resolved the hub revision
+        path = artifact_path(model_id, precision, cache_dir)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save(model, tmp_path)
+        os.replace(tmp_path, path + ".pt")
+        return model
+
+    if os.path.isdir(path):
+        model = BlipForConditionalGeneration.from_pretrained(path, dtype=torch.bfloat16)
+        # Keep the fingerprint of the original checkpoint so caches keyed on it still hit
+        with open(os.path.join(path, "source.json")) as f:
+            source = json.load(f)
+        model.config._name_or_path = source["name_or_path"]
+        model.config._commit_hash = source["commit_hash"]
+        model.precision_mode = precision
+        return model.eval()
+    model = apply_precision(load_fp32(), precision)
+    path = artifact_path(model_id, precision, cache_dir)
+    tmp_dir = f"{path}.{os.getpid()}.tmp"
+    model.save_pretrained(tmp_dir)
+    with open(os.path.join(tmp_dir, "source.json"), "w") as f:
+        json.dump({"name_or_path": model.config._name_or_path,
+                   "commit_hash": getattr(model.config, "_commit_hash", None)}, f)
+    try:
+        os.rename(tmp_dir, path)
+    except OSError:
+        # Another process finished first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return model
+
+
+def _rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return None
+
+
+def measure_precision(model_id, precision, image_paths, batch_size, generate_kwargs):
+    """Load and caption with one precision; meant for a fresh process so memory figures are its own."""
+    import resource
+    from blip_loader import get_processor, get_model
+    from caption_engine import generate_captions
+
+    start = time.perf_counter()
+    model = get_model(model_id, precision)
+    load_seconds = time.perf_counter() - start
+    processor = get_processor(model_id)
+    generate_captions(image_paths[:batch_size], processor, model, batch_size=batch_size, workers=0,
+                      **generate_kwargs)
+
+    start = time.perf_counter()
+    captions = generate_captions(image_paths, processor, model, batch_size=batch_size, workers=0, **generate_kwargs)
+    seconds = time.perf_counter() - start
+    return {
+        "precision": precision,
+        "load_seconds": load_seconds,
+        "images_per_sec": len(image_paths) / seconds,
+        "rss_mb": _rss_mb(),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "captions": captions,
+    }
+
+
+def compare_precisions(model_id, image_paths, precisions=PRECISIONS, batch_size=8,
+                       captions_file=DEFAULT_CAPTIONS_FILE, **generate_kwargs):
+    """Throughput, memory and BLEU/METEOR drift against fp32 for each precision, on the same images."""
+    from evaluator import bleu_scores, meteor_scores
+    from blip_loader import wordnet_installed
+
+    context = multiprocessing.get_context("spawn")
+    rows = []
+    for precision in precisions:
+        with context.Pool(1) as pool:
+            rows.append(pool.apply(measure_precision, (model_id, precision, image_paths, batch_size, generate_kwargs)))
+
+    ground_truth = load_captions(captions_file)
+    names = [os.path.basename(path) for path in image_paths]
+    scored = [i for i, name in enumerate(names) if name in ground_truth]
+    references = [[caption.split() for caption in ground_truth.captions(names[i])] for i in scored]
+    with_meteor = bool(scored) and wordnet_installed()
+    for row in rows:
+        candidates = [row["captions"][i].split() for i in scored]
+        row["bleu4"] = float(bleu_scores(references, candidates)[1][:, 3].mean()) if scored else None
+        row["meteor"] = float(np.mean(meteor_scores(references, candidates, workers=0))) if with_meteor else None
+
+    baseline = next((row for row in rows if row["precision"] == "fp32"), rows[0])
+    for row in rows:
+        row["same_as_baseline"] = float(np.mean([a == b for a, b in zip(row["captions"], baseline["captions"])]))
+        for metric in ("bleu4", "meteor"):
+            row[f"{metric}_drift"] = (row[metric] - baseline[metric]) if row[metric] is not None else None
+    return rows
+
+
+def print_comparison(rows):
+    print(f"{'mode':<6} {'load s':>7} {'img/s':>8} {'RSS MiB':>8} {'peak MiB':>9} {'BLEU-4':>8} {'drift':>8} "
+          f"{'METEOR':>8} {'drift':>8} {'same':>6}")
+    for row in rows:
+        def fmt(value, spec):
+            return format(value, spec) if value is not None else "-"
+        print(f"{row['precision']:<6} {row['load_seconds']:>7.2f} {row['images_per_sec']:>8.2f} "
+              f"{fmt(row['rss_mb'], '.0f'):>8} {row['peak_rss_mb']:>9.0f} {fmt(row['bleu4'], '.4f'):>8} "
+              f"{fmt(row['bleu4_drift'], '+.4f'):>8} {fmt(row['meteor'], '.4f'):>8} "
+              f"{fmt(row['meteor_drift'], '+.4f'):>8} {row['same_as_baseline']:>6.0%}")
+
+
+if __name__ == "__main__":
+    from blip_loader import MODEL_ID
+    from caption_engine import GREEDY, BEAM_SEARCH
+    from image_pipeline import iter_image_paths
+
+    parser = argparse.ArgumentParser(description="Compare fp32, dynamic int8 and bf16 BLIP on the same images")
+    parser.add_argument("--images", default="images")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--modes", default=",".join(PRECISIONS))
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--model", default=MODEL_ID, help="model id or local directory")
+    parser.add_argument("--beam", action="store_true", help="use num_beams=5 instead of greedy decoding")
+    parser.add_argument("--output", default=None, help="also write the rows as JSON")
+    args = parser.parse_args()
+
+    image_paths = list(iter_image_paths(args.images, args.limit))
+    rows = compare_precisions(args.model, image_paths, args.modes.split(","), args.batch_size,
+                              **(BEAM_SEARCH if args.beam else GREEDY))
+    print_comparison(rows)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=2)
+        print(f"Wrote {args.output}", file=sys.stderr)
@@ -0,0 +1,162 @@
+import os
+import csv
+import json
+import time
+import hashlib
+import argparse
+
+from embedding_cache import file_hash
+
+DEFAULT_STORE_PATH = os.path.join(".cache", "results.jsonl")
+
+
+def generation_id(generate_kwargs):
+    return json.dumps(generate_kwargs, sort_keys=True, default=str)
+
+
+def result_key(image_hash, model_id, generate_kwargs):
+    """Identify a caption by the image bytes, the weights that produced it and the decoding settings."""
+    raw = "\n".join([image_hash, model_id, generation_id(generate_kwargs)])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class ResultStore:
+    """Append-only JSON-lines log of generated captions, their scores and timings.
+
+    Records are keyed by result_key; when a key appears more than once the last record wins, so
+    adding scores later is just another append. Image hashes are remembered per (path, size,
+    mtime) so an unchanged folder is not re-read on every run.
+    """
+
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._records = {}
+        self._hashes = {}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        for line in data.splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash; the image is simply captioned again
+                continue
+            self._records[record["key"]] = record
+            self._hashes[tuple(record["file"])] = record["image_hash"]
+        if data and not data.endswith(b"\n"):
+            with open(self.path, "ab") as f:
+                f.write(b"\n")
+
+    def __len__(self):
+        return len(self._records)
+
+    def records(self):
+        return self._records.values()
+
+    def _file_id(self, image_path):
+        stat = os.stat(image_path)
+        return (os.path.abspath(image_path), stat.st_size, stat.st_mtime_ns)
+
+    def image_hash(self, image_path):
+        file_id = self._file_id(image_path)
+        image_hash = self._hashes.get(file_id)
+        if image_hash is None:
+            image_hash = self._hashes[file_id] = file_hash(image_path)
+        return image_hash
+
+    def get(self, image_path, model_id, generate_kwargs):
+        record = self._records.get(result_key(self.image_hash(image_path), model_id, generate_kwargs))
+        if record is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return record
+
+    def put(self, image_path, model_id, generate_kwargs, caption, scores=None, seconds=None):
+        image_hash = self.image_hash(image_path)
+        key = result_key(image_hash, model_id, generate_kwargs)
+        previous = self._records.get(key, {})
+        record = {
+            "key": key,
+            "image": os.path.basename(image_path),
+            "file": list(self._file_id(image_path)),
+            "image_hash": image_hash,
+            "model": model_id,
+            "generation": generation_id(generate_kwargs),
+            "caption": caption,
+            "scores": {**previous.get("scores", {}), **(scores or {})},
+            "seconds": seconds if seconds is not None else previous.get("seconds"),
+            "created": time.time(),
+        }
+        # One write call per record keeps lines whole when several processes append at once
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(record) + "\n").encode())
+        finally:
+            os.close(fd)
+        self._records[key] = record
+        return record
+
+    def add_scores(self, image_path, model_id, generate_kwargs, scores):
+        record = self.get(image_path, model_id, generate_kwargs)
+        if record is None:
+            raise KeyError(f"no stored caption for {image_path}")
+        return self.put(image_path, model_id, generate_kwargs, record["caption"], scores=scores)
+
+    def missing(self, image_paths, model_id, generate_kwargs):
+        """The image paths that are new or changed since they were last captioned with these settings."""
+        return [path for path in image_paths if self.get(path, model_id, generate_kwargs) is None]
+
+    def export_csv(self, image_paths, model_id, generate_kwargs, output="results.csv", ground_truth=None):
+        """Write the stored captions for image_paths in the results.csv layout; returns the row count."""
+        from sharded_runner import RESULT_COLUMNS, result_row
+
+        rows = []
+        for path in sorted(image_paths, key=os.path.basename):
+            record = self.get(path, model_id, generate_kwargs)
+            if record is not None:
+                references = ground_truth.captions(record["image"]) if ground_truth is not None else []
+                rows.append(result_row(record["image"], record["caption"], references))
+        tmp_path = f"{output}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(RESULT_COLUMNS)
+            writer.writerows(rows)
+        os.replace(tmp_path, output)
+        return len(rows)
+
+
+if __name__ == "__main__":
+    from image_pipeline import iter_image_paths
+    from ground_truth import load_captions, DEFAULT_CAPTIONS_FILE
+
+    parser = argparse.ArgumentParser(description="Summarise the result store and export it as results.csv")
+    parser.add_argument("--store", default=DEFAULT_STORE_PATH)
+    parser.add_argument("--images", default="images")
+    parser.add_argument("--output", default=None, help="export the newest model/settings pair to this CSV")
+    args = parser.parse_args()
+
+    store = ResultStore(args.store)
+    groups = {}
+    for record in store.records():
+        group = groups.setdefault((record["model"], record["generation"]), [0, 0.0])
+        group[0] += 1
+        group[1] = max(group[1], record["created"])
+    print(f"{len(store)} records in {args.store}")
+    for (model_id, generation), (count, _) in sorted(groups.items(), key=lambda item: -item[1][1]):
+        print(f"{count:>6}  {model_id}  {generation}")
+
+    if args.output and groups:
+        model_id, generation = max(groups, key=lambda group: groups[group][1])
+        ground_truth = load_captions(DEFAULT_CAPTIONS_FILE) if os.path.exists(DEFAULT_CAPTIONS_FILE) else None
+        rows = store.export_csv(list(iter_image_paths(args.images)), model_id, json.loads(generation),
+                                args.output, ground_truth)
+        print(f"Wrote {rows} rows to {args.output}")
@@ -0,0 +1,241 @@
+import io
+import os
+import csv
+import glob
+import json
+import time
+import hashlib
+import argparse
+import multiprocessing
+
+from image_pipeline import PrefetchPipeline, iter_image_paths
+from ground_truth import load_captions, DEFAULT_CAPTIONS_FILE
+from cider import tokenize
+from result_store import ResultStore, DEFAULT_STORE_PATH, generation_id
+
+RESULT_COLUMNS = ["Image Filename", "Generated Caption", "Ground Truth Caption", "Exact Match Accuracy"]
+DEFAULT_SHARD_DIR = os.path.join(".cache", "shards")
+DEFAULT_OUTPUT = "results.csv"
+CONFIG_FILE = "config.json"
+
+
+def shard_path(shard_dir, shard):
+    return os.path.join(shard_dir, f"shard-{shard:03d}.csv")
+
+
+def config_dir(shard_dir, fingerprint, generate_kwargs):
+    """The subdirectory of shard_dir holding the shards of one model and decoding settings.
+
+    Rows are only resumed and merged from the directory of the configuration being run, so a
+    later run with another model, precision or decoding never picks up captions it did not make.
+    """
+    config = {"model": fingerprint, "generation": generation_id(generate_kwargs)}
+    key = hashlib.sha256("\n".join([config["model"], config["generation"]]).encode()).hexdigest()[:16]
+    path = os.path.join(shard_dir, key)
+    config_path = os.path.join(path, CONFIG_FILE)
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            if json.load(f) != config:
+                raise ValueError(f"{path} holds shards for another configuration")
+    else:
+        os.makedirs(path, exist_ok=True)
+        with open(config_path, "w") as f:
+            json.dump(config, f, indent=2)
+    return path
+
+
+def other_configs(shard_dir, current):
+    """Shard directories under shard_dir that belong to other configurations, and whether unlabelled shards exist."""
+    others = []
+    for config_path in sorted(glob.glob(os.path.join(shard_dir, "*", CONFIG_FILE))):
+        path = os.path.dirname(config_path)
+        if os.path.abspath(path) != os.path.abspath(current):
+            with open(config_path) as f:
+                others.append((path, json.load(f)))
+    return others, bool(glob.glob(os.path.join(shard_dir, "shard-*.csv")))
+
+
+def result_row(image_name, caption, references):
+    """A results.csv row: the first reference is shown, but an exact match against any reference counts."""
+    normalized = tokenize(caption)
+    exact = any(tokenize(reference) == normalized for reference in references)
+    return [image_name, caption, references[0] if references else "", int(exact)]
+
+
+def read_shards(shard_dir):
+    """Every row committed to a shard file, keyed by image filename (the first commit wins)."""
+    rows = {}
+    for path in sorted(glob.glob(os.path.join(shard_dir, "shard-*.csv"))):
+        with open(path, newline="", encoding="utf-8") as f:
+            text = f.read()
+        # Text after the last newline is a row that was never committed
+        for row in csv.reader(io.StringIO(text[:text.rfind("\n") + 1])):
+            if len(row) == len(RESULT_COLUMNS) and row != RESULT_COLUMNS:
+                rows.setdefault(row[0], row)
+    return rows
+
+
+def _truncate_partial_row(path):
+    # A crash mid-write can leave a row without its newline; drop it so that image is redone
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+
+def _run_shard(shard, image_paths, shard_dir, model_id, threads, batch_size, captions_file, store_path,
+               generate_kwargs):
+    import torch
+    from blip_loader import get_processor, get_model
+    from embedding_cache import model_fingerprint
+
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    processor = get_processor(model_id)
+    model = get_model(model_id)
+    ground_truth = load_captions(captions_file) if os.path.exists(captions_file) else None
+    store = ResultStore(store_path) if store_path else None
+    fingerprint = model_fingerprint(model)
+
+    def row_for(image_path, caption):
+        name = os.path.basename(image_path)
+        return result_row(name, caption, ground_truth.captions(name) if ground_truth is not None else [])
+
+    path = shard_path(shard_dir, shard)
+    if os.path.exists(path):
+        _truncate_partial_row(path)
+    new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+
+    start = time.perf_counter()
+    done = 0
+    with open(path, "a", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(RESULT_COLUMNS)
+
+        # Images the store already captioned with this model and these settings are copied, not rerun
+        todo = []
+        for image_path in image_paths:
+            record = store.get(image_path, fingerprint, generate_kwargs) if store is not None else None
+            if record is None:
+                todo.append(image_path)
+            else:
+                writer.writerow(row_for(image_path, record["caption"]))
+        f.flush()
+        os.fsync(f.fileno())
+
+        # One decode thread is enough to stay ahead of a worker limited to a few torch threads
+        pipeline = PrefetchPipeline(todo, processor, batch_size, workers=1)
+        for batch_paths, pixel_values in pipeline:
+            batch_start = time.perf_counter()
+            with torch.no_grad():
+                out = model.generate(pixel_values=pixel_values, **generate_kwargs)
+            captions = processor.batch_decode(out, skip_special_tokens=True)
+            seconds = (time.perf_counter() - batch_start) / len(batch_paths)
+            for image_path, caption in zip(batch_paths, captions):
+                row = row_for(image_path, caption)
+                writer.writerow(row)
+                if store is not None:
+                    store.put(image_path, fingerprint, generate_kwargs, caption, scores={"exact_match": row[3]},
+                              seconds=seconds)
+            # Commit the batch before starting the next, so a crash loses at most one batch
+            f.flush()
+            os.fsync(f.fileno())
+            done += len(batch_paths)
+    return shard, len(image_paths), done, time.perf_counter() - start
+
+
+def merge_shards(shard_dir=DEFAULT_SHARD_DIR, output=DEFAULT_OUTPUT):
+    """Write every committed row to output in image-name order; returns the row count."""
+    rows = read_shards(shard_dir)
+    tmp_path = f"{output}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(RESULT_COLUMNS)
+        for name in sorted(rows):
+            writer.writerow(rows[name])
+    os.replace(tmp_path, output)
+    return len(rows)
+
+
+def run_sharded(image_folder, workers=2, threads_per_worker=None, batch_size=8, shard_dir=DEFAULT_SHARD_DIR,
+                output=DEFAULT_OUTPUT, model_id=None, limit=None, captions_file=DEFAULT_CAPTIONS_FILE,
+                store_path=DEFAULT_STORE_PATH, **generate_kwargs):
+    """Caption image_folder on `workers` processes, skipping images a previous run already committed.
+
+    Pending images are dealt round-robin into one shard per worker. Each worker appends its rows to
+    its own shard file and fsyncs after every batch; the shards are then merged into output. Shards
+    live in a subdirectory per model fingerprint and decoding settings (see config_dir), so only rows
+    made by this configuration count as committed. Images the result store already holds for the
+    same model and settings are copied from it instead of captioned.
+    """
+    from blip_loader import MODEL_ID, model_fingerprint_for
+
+    model_id = model_id or MODEL_ID
+    run_dir = config_dir(shard_dir, model_fingerprint_for(model_id), generate_kwargs)
+    others, unlabelled = other_configs(shard_dir, run_dir)
+    for path, config in others:
+        print(f"Ignoring shards in {path} from another configuration ({config['model']}, {config['generation']})")
+    if unlabelled:
+        print(f"Ignoring shard files directly in {shard_dir}; they do not record the model or settings that made them")
+
+    image_paths = list(iter_image_paths(image_folder, limit))
+    committed = read_shards(run_dir)
+    pending = [path for path in image_paths if os.path.basename(path) not in committed]
+    print(f"{len(image_paths)} images: {len(image_paths) - len(pending)} already committed, "
+          f"{len(pending)} to caption on {workers} workers")
+
+    if pending:
+        threads = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+        # Spawned workers inherit these before numpy or torch size their thread pools
+        for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+            os.environ[var] = str(threads)
+        shards = [(k, pending[k::workers]) for k in range(workers) if pending[k::workers]]
+        start = time.perf_counter()
+        with multiprocessing.get_context("spawn").Pool(len(shards)) as pool:
+            results = pool.starmap(_run_shard, [
+                (k, paths, run_dir, model_id, threads, batch_size, captions_file, store_path,
+                 generate_kwargs)
+                for k, paths in shards
+            ])
+        elapsed = time.perf_counter() - start
+        for shard, count, captioned, seconds in results:
+            print(f"shard {shard}: {count} images ({count - captioned} from the result store), {captioned} "
+                  f"captioned in {seconds:.1f}s")
+        print(f"total: {len(pending)} images in {elapsed:.1f}s ({len(pending) / elapsed:.2f} img/s, "
+              f"{threads} torch threads per worker)")
+
+    rows = merge_shards(run_dir, output)
+    print(f"Wrote {rows} rows to {output}")
+    return rows
+
+
+if __name__ == "__main__":
+    from caption_engine import GREEDY, BEAM_SEARCH
+    from host_profile import tuned
+
+    parser = argparse.ArgumentParser(description="Caption a whole image folder on several processes, resumably")
+    parser.add_argument("--images", default="images")
+    parser.add_argument("--limit", type=int, default=None)
+    # Defaults come from this host's tuning profile when autotune.py has written one
+    parser.add_argument("--workers", type=int, default=tuned("processes", 2))
+    parser.add_argument("--threads-per-worker", type=int, default=tuned("threads_per_process", None),
+                        help="torch intra-op threads per worker (default: CPUs / workers)")
+    parser.add_argument("--batch-size", type=int, default=tuned("batch_size", 8))
+    parser.add_argument("--shard-dir", default=DEFAULT_SHARD_DIR)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    parser.add_argument("--store", default=DEFAULT_STORE_PATH, help="result store to reuse captions from ('' to disable)")
+    parser.add_argument("--model", default=None, help="model id or local directory (default: BLIP base)")
+    parser.add_argument("--beam", action="store_true", help="use num_beams=5 instead of greedy decoding")
+    parser.add_argument("--merge-only", action="store_true", help="only rebuild the output from existing shards")
+    args = parser.parse_args()
+
+    generate_kwargs = BEAM_SEARCH if args.beam else GREEDY
+    if args.merge_only:
+        from blip_loader import MODEL_ID, model_fingerprint_for
+
+        run_dir = config_dir(args.shard_dir, model_fingerprint_for(args.model or MODEL_ID), generate_kwargs)
+        print(f"Wrote {merge_shards(run_dir, args.output)} rows to {args.output}")
+    else:
+        run_sharded(args.images, args.workers, args.threads_per_worker, args.batch_size, args.shard_dir,
+                    args.output, args.model, args.limit, store_path=args.store, **generate_kwargs)
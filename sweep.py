@@ -0,0 +1,169 @@
+import os
+import csv
+import json
+import time
+import argparse
+import numpy as np
+
+from image_pipeline import batched, iter_image_paths
+from ground_truth import load_captions, DEFAULT_CAPTIONS_FILE
+from result_store import generation_id
+
+DEFAULT_CONFIGS = ("greedy", "beam")
+
+
+def parse_config(text):
+    """'greedy', 'beam' or 'name={"num_beams": 3, ...}' to (name, generate kwargs)."""
+    from caption_engine import GREEDY, BEAM_SEARCH
+
+    presets = {"greedy": GREEDY, "beam": BEAM_SEARCH}
+    name, sep, spec = text.partition("=")
+    if not sep:
+        if name not in presets:
+            raise ValueError(f"unknown preset {name!r}; use {', '.join(presets)} or name={{json kwargs}}")
+        return name, dict(presets[name])
+    return name, json.loads(spec)
+
+
+def duplicate_names(configs):
+    names = [name for name, _ in configs]
+    return sorted({name for name in names if names.count(name) > 1})
+
+
+def sweep(image_paths, processor, model, configs, batch_size=8, dataset=None, decode=None):
+    """Caption image_paths under every (name, generate_kwargs) in configs, decoding and encoding each image once.
+
+    Each batch goes through preprocessing and the vision encoder a single time; the image
+    embeddings are then handed to the text decoder once per distinct set of kwargs (configs
+    with identical kwargs share captions). Returns (captions per config name, shared seconds by
+    stage, generate seconds per config name). Config names must be unique.
+    """
+    from caption_engine import preprocess, encode_images, generate_from_embeds
+    from fast_decode import decode_mode
+
+    duplicates = duplicate_names(configs)
+    if duplicates:
+        raise ValueError(f"config names must be unique; repeated: {', '.join(duplicates)}")
+    decode = decode_mode(decode)
+    distinct = {}
+    for name, generate_kwargs in configs:
+        distinct.setdefault(generation_id(generate_kwargs), (generate_kwargs, []))[1].append(name)
+
+    captions = {name: [] for name, _ in configs}
+    seconds = {name: 0.0 for name, _ in configs}
+    shared = {"preprocess": 0.0, "vision_encoder": 0.0}
+    for batch_paths in batched(image_paths, batch_size):
+        start = time.perf_counter()
+        pixel_values = preprocess(batch_paths, processor, dataset, decode)
+        encoded = time.perf_counter()
+        image_embeds = encode_images(model, pixel_values)
+        shared["preprocess"] += encoded - start
+        shared["vision_encoder"] += time.perf_counter() - encoded
+
+        for generate_kwargs, names in distinct.values():
+            start = time.perf_counter()
+            out = generate_from_embeds(model, image_embeds, **generate_kwargs)
+            batch_captions = processor.batch_decode(out, skip_special_tokens=True)
+            elapsed = time.perf_counter() - start
+            for name in names:
+                captions[name].extend(batch_captions)
+                seconds[name] += elapsed
+    return captions, shared, seconds
+
+
+def score_configs(image_paths, captions, shared, seconds, configs, captions_file=DEFAULT_CAPTIONS_FILE):
+    """One row per config: BLEU-4, METEOR, CIDEr-D and exact match against the same references, plus throughput.
+
+    Throughput is what the config would reach run on its own: the shared preprocessing and encoder
+    time plus its own text-decoder time.
+    """
+    from evaluator import bleu_scores, meteor_scores
+    from cider import load_cider
+    from blip_loader import wordnet_installed
+    from sharded_runner import result_row
+
+    ground_truth = load_captions(captions_file)
+    cider = load_cider(captions_file)
+    names = [os.path.basename(path) for path in image_paths]
+    references = [ground_truth.references(name) for name in names]
+    with_meteor = wordnet_installed()
+    shared_seconds = sum(shared.values())
+
+    rows = []
+    for name, generate_kwargs in configs:
+        candidates = [caption.split() for caption in captions[name]]
+        corpus_bleu, sentence_bleu = bleu_scores(references, candidates)
+        meteor = meteor_scores(references, candidates, workers=0) if with_meteor else None
+        exact = [result_row(image, caption, ground_truth.captions(image))[3]
+                 for image, caption in zip(names, captions[name])]
+        rows.append({
+            "config": name,
+            "generate_kwargs": generate_kwargs,
+            "corpus_bleu4": float(corpus_bleu[3]),
+            "mean_bleu4": float(sentence_bleu[:, 3].mean()),
+            "meteor": float(np.mean(meteor)) if meteor is not None else None,
+            "cider_d": float(cider.score(captions[name], names)[0]),
+            "exact_match": float(np.mean(exact)),
+            "generate_ms_per_image": seconds[name] / len(names) * 1000,
+            "images_per_sec": len(names) / (shared_seconds + seconds[name]),
+        })
+    return rows
+
+
+def print_table(rows, shared, num_images, wall_seconds):
+    print(f"\n{'config':<12} {'BLEU-4':>7} {'sent B4':>7} {'METEOR':>7} {'CIDEr-D':>7} {'exact':>6} "
+          f"{'gen ms/img':>10} {'img/s':>7}  kwargs")
+    for row in rows:
+        meteor = f"{row['meteor']:.4f}" if row["meteor"] is not None else "-"
+        print(f"{row['config']:<12} {row['corpus_bleu4']:>7.4f} {row['mean_bleu4']:>7.4f} {meteor:>7} "
+              f"{row['cider_d']:>7.4f} {row['exact_match']:>6.1%} {row['generate_ms_per_image']:>10.1f} "
+              f"{row['images_per_sec']:>7.2f}  {json.dumps(row['generate_kwargs'], sort_keys=True)}")
+    separate = sum(num_images / row["images_per_sec"] for row in rows)
+    print(f"\n{num_images} images; shared work {', '.join(f'{k} {v:.1f}s' for k, v in shared.items())}. "
+          f"Sweep took {wall_seconds:.1f}s against {separate:.1f}s for separate runs.")
+
+
+if __name__ == "__main__":
+    from blip_loader import get_processor, get_model, MODEL_ID
+    from image_dataset import open_dataset
+
+    parser = argparse.ArgumentParser(description="Caption a sample once per generation config, sharing the image "
+                                                 "decoding and vision encoder, and compare quality and throughput")
+    parser.add_argument("configs", nargs="*", default=list(DEFAULT_CONFIGS),
+                        help='"greedy", "beam" or name=\'{"num_beams": 3}\' (default: greedy beam)')
+    parser.add_argument("--images", default="images")
+    parser.add_argument("--captions", default=DEFAULT_CAPTIONS_FILE)
+    parser.add_argument("--limit", type=int, default=100, help="images with references to caption")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--model", default=MODEL_ID, help="model id or local directory")
+    parser.add_argument("--precision", default=None, help="fp32, int8 or bf16 (default: $CAPTION_PRECISION)")
+    parser.add_argument("--backend", default=None, help="eager, compile or trace (default: $CAPTION_BACKEND)")
+    parser.add_argument("--output", default=None, help="CSV with one caption column per config")
+    parser.add_argument("--json", default=None, help="also write the table rows as JSON")
+    args = parser.parse_args()
+
+    configs = [parse_config(text) for text in args.configs]
+    if duplicate_names(configs):
+        parser.error(f"config names must be unique; repeated: {', '.join(duplicate_names(configs))}")
+    ground_truth = load_captions(args.captions)
+    image_paths = [path for path in iter_image_paths(args.images) if os.path.basename(path) in ground_truth]
+    image_paths = image_paths[:args.limit]
+
+    processor = get_processor(args.model)
+    model = get_model(args.model, args.precision, args.backend)
+    start = time.perf_counter()
+    captions, shared, seconds = sweep(image_paths, processor, model, configs, args.batch_size, open_dataset())
+    wall_seconds = time.perf_counter() - start
+    rows = score_configs(image_paths, captions, shared, seconds, configs, args.captions)
+    print_table(rows, shared, len(image_paths), wall_seconds)
+
+    if args.output:
+        with open(args.output, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["Image Filename"] + [name for name, _ in configs])
+            for i, path in enumerate(image_paths):
+                writer.writerow([os.path.basename(path)] + [captions[name][i] for name, _ in configs])
+        print(f"Wrote {args.output}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)